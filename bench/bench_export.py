@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк экспорта без сети: TelegramClient подменяется локальным фейком
+через core.set_client_factory, и замеряется весь путь export_messages_range —
+от «подключения» до готового файла.
+
+    python bench/bench_export.py --messages 100000 --topics 20 --authors 500 --latency 0.02
+    python bench/bench_export.py --messages 300000 --json bench_results.jsonl   # для сравнения между версиями
+"""
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import core
+from fake_telegram import FakeHistory, FakeTelegramClient
+from writers import WRITERS, XLSX_LAYOUTS
+
+START = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def run_once(args, history, workdir):
+    fake = FakeTelegramClient(history, latency=args.latency, flood_every=args.flood_every,
+                              drop_every=args.drop_every)
+    core.set_client_factory(lambda *a, **kw: fake)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        end = START + datetime.timedelta(days=args.days)
+        t0 = time.perf_counter()
+        res = core.export_messages_range(0, "", core.SESSION_NAME, None, 1, START, end,
+                                         log_callback=lambda s: None, use_cache=args.cache,
+                                         formats=args.formats, media=bool(args.media), shards=args.shards,
+                                         layout=args.layout, search_index=False)
+        elapsed = time.perf_counter() - t0
+    finally:
+        os.chdir(cwd)
+        core.set_client_factory(None)
+    if not res.get("success"):
+        raise SystemExit(f"Экспорт не удался: {res.get('message')}")
+    stats = res["stats"]
+    return {
+        "messages_in_history": history.count,
+        "messages_fetched": fake.fetched,
+        "messages_exported": res["count"],
+        "time_to_file_sec": round(elapsed, 3),
+        "throughput_msg_per_sec": round(res["count"] / elapsed, 1),
+        "file_size_mb": {os.path.splitext(f)[1][1:]: round(os.path.getsize(f) / 1024 / 1024, 2) for f in res["files"]},
+        "requests": stats["requests"],
+        "retries": stats["retries"],
+        "media": stats["media"],
+        "downloads": fake.downloads,
+        "phases": stats["phases"],
+        "peak_rss_mb": stats["peak_rss_mb"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    parser.add_argument("--messages", type=int, default=50000, help="сообщений в экспортируемом периоде")
+    parser.add_argument("--days", type=int, default=30, help="длина экспортируемого периода в днях")
+    parser.add_argument("--tail-days", type=int, default=0,
+                        help="история после конца периода (проверка, что экспорт её не читает)")
+    parser.add_argument("--topics", type=int, default=10, help="топиков форума (0 — обычный чат)")
+    parser.add_argument("--authors", type=int, default=200, help="разных авторов")
+    parser.add_argument("--text-size", type=int, default=120, help="средняя длина сообщения, символов")
+    parser.add_argument("--unresolved", type=float, default=0.0,
+                        help="доля сообщений, чей автор не пришёл со страницей истории")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка одного запроса, с")
+    parser.add_argument("--flood-every", type=int, default=0, help="FloodWait 1 с на каждую N-ю страницу")
+    parser.add_argument("--drop-every", type=int, default=0,
+                        help="обрыв соединения на каждой N-й странице (проверка переподключения)")
+    parser.add_argument("--format", dest="formats", nargs="+", default=["xlsx"], choices=list(WRITERS),
+                        help="форматы файлов, все пишутся из одной загрузки")
+    parser.add_argument("--media", type=float, default=0.0, metavar="FRACTION",
+                        help="доля сообщений с вложением; вложения скачиваются (повторы в прогонах не качаются)")
+    parser.add_argument("--layout", choices=XLSX_LAYOUTS, default="sheets", help="раскладка xlsx")
+    parser.add_argument("--shards", type=int, default=1, help="читать период N частями параллельно")
+    parser.add_argument("--cache", action="store_true", help="экспорт с локальным кэшем сообщений")
+    parser.add_argument("--runs", type=int, default=1, help="число повторов (с --cache второй идёт из кэша)")
+    parser.add_argument("--json", metavar="FILE", help="дописать результаты строкой JSON в FILE")
+    args = parser.parse_args()
+
+    total_days = args.days + args.tail_days
+    history = FakeHistory(START, args.messages * total_days // args.days, span_days=total_days,
+                          topics=args.topics, authors=args.authors, text_size=args.text_size,
+                          unresolved=args.unresolved, media=args.media)
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for n in range(args.runs):
+            res = run_once(args, history, workdir)
+            results.append(res)
+            phases = ", ".join(f"{k} {v:.2f}" for k, v in res["phases"].items())
+            sizes = ", ".join(f"{fmt} {mb}" for fmt, mb in res["file_size_mb"].items())
+            print(f"[{n + 1}/{args.runs}] экспортировано {res['messages_exported']} "
+                  f"(прочитано {res['messages_fetched']} из {res['messages_in_history']}) "
+                  f"за {res['time_to_file_sec']:.2f} c — {res['throughput_msg_per_sec']:.0f} сообщ./с, "
+                  f"запросов {res['requests']}, переподключений {res['retries']}, файлы (МБ): {sizes}, пиковая память {res['peak_rss_mb']} МБ")
+            print(f"        фазы, c: {phases}")
+            if res["media"]:
+                print(f"        вложения: {res['media']}, запросов файлов {res['downloads']}")
+
+    if args.json:
+        record = {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+                  "version": core.PROGRAM_VERSION, "params": vars(args), "runs": results}
+        with open(args.json, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
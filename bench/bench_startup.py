@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк запуска: сколько проходит от старта интерпретатора до готовности точек входа.
+Каждый случай запускается отдельным процессом во временной папке (с тестовым .env),
+выводятся лучшее и медианное время из --runs запусков.
+
+    python bench/bench_startup.py --runs 10
+    python bench/bench_startup.py --imports 8     # самые долгие импорты каждого случая (-X importtime)
+
+Окно GUI строится только при наличии дисплея; без него замеряется запуск до создания окна.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+CLI = os.path.join(ROOT, "tg-chat-exp-excel-cli.py")
+GUI = os.path.join(ROOT, "tg-chat-exp-excel.py")
+
+# модуль GUI выполняется без run_gui(); окно строится и отрисовывается один раз, после чего закрывается
+GUI_PROBE = f"""
+import runpy, sys, tkinter
+sys.path.insert(0, {ROOT!r})
+gui = runpy.run_path({GUI!r}, run_name="bench_startup")
+try:
+    root = tkinter.Tk()
+except tkinter.TclError:
+    print("no display")
+    sys.exit(0)
+app = gui["ChatExporterGUI"](root)
+root.update()
+app.on_close()
+"""
+
+CASES = [
+    ("python (пустой запуск)", [sys.executable, "-c", "pass"]),
+    ("cli --help", [sys.executable, CLI, "--help"]),
+    ("cli chats --cached", [sys.executable, CLI, "chats", "--cached"]),
+    ("gui: окно", [sys.executable, "-c", GUI_PROBE]),
+]
+
+
+def run_case(cmd, cwd):
+    """(секунды, stdout) одного запуска."""
+    t0 = time.perf_counter()
+    proc = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.perf_counter() - t0
+    if proc.returncode not in (0, 1):
+        raise SystemExit(f"{' '.join(cmd[:3])}: код {proc.returncode}\n{proc.stderr}")
+    return elapsed, proc.stdout
+
+
+def top_imports(cmd, cwd, count):
+    """Самые долгие импорты верхнего уровня по -X importtime: [(мс, модуль)]."""
+    proc = subprocess.run(cmd[:1] + ["-X", "importtime"] + cmd[1:], cwd=cwd,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):  # только импорты верхнего уровня
+            rows.append((int(cumulative) / 1000, name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    parser.add_argument("--runs", type=int, default=7, help="запусков каждого случая")
+    parser.add_argument("--imports", type=int, default=0, metavar="N",
+                        help="показать N самых долгих импортов каждого случая")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        with open(os.path.join(workdir, ".env"), "w", encoding="utf-8") as f:
+            f.write("API_ID=1\nAPI_HASH=bench\nPHONE=+10000000000\n")
+        for label, cmd in CASES:
+            run_case(cmd, workdir)  # прогрев: байт-код и файловый кэш ОС
+            times = []
+            for _ in range(args.runs):
+                elapsed, out = run_case(cmd, workdir)
+                times.append(elapsed)
+            if "no display" in out:
+                label += " (нет дисплея — без окна)"
+            print(f"{label:40} лучшее {min(times) * 1000:6.0f} мс, медиана {statistics.median(times) * 1000:6.0f} мс")
+            for ms, name in top_imports(cmd, workdir, args.imports):
+                print(f"    {ms:6.1f} мс  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк записи файлов без Telegram: синтетическая история складывается в MessageStore,
+после чего каждый формат пишется из него несколько раз; выводятся сообщений в секунду
+и пиковая память процесса.
+
+    python bench/bench_write.py --messages 100000 --topics 10 --format xlsx csv
+    python bench/bench_write.py --layout sheets table     # сравнить раскладки xlsx
+"""
+
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import core
+from fake_telegram import FakeHistory
+from storage import MessageStore
+from writers import WRITERS, XLSX_LAYOUTS, write_file
+
+START = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def fill_store(store, history):
+    store.add_messages(1, (
+        (msg.id, int(msg.date.timestamp()), history.topic_of(i), msg.sender_id,
+         core._format_author(msg.sender), msg.message, None)
+        for i in range(history.count)
+        for msg in (history.message(i),)
+    ))
+    store.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    parser.add_argument("--messages", type=int, default=100000, help="сообщений в периоде")
+    parser.add_argument("--days", type=int, default=30, help="длина периода в днях")
+    parser.add_argument("--topics", type=int, default=10, help="топиков форума (0 — обычный чат)")
+    parser.add_argument("--authors", type=int, default=300, help="разных авторов")
+    parser.add_argument("--text-size", type=int, default=80, help="средняя длина сообщения, символов")
+    parser.add_argument("--format", dest="formats", nargs="+", default=["xlsx"], choices=list(WRITERS))
+    parser.add_argument("--layout", dest="layouts", nargs="+", default=["sheets"], choices=XLSX_LAYOUTS,
+                        help="раскладки xlsx (каждая замеряется отдельно)")
+    parser.add_argument("--runs", type=int, default=3, help="повторов каждого формата (берётся лучший)")
+    args = parser.parse_args()
+
+    history = FakeHistory(START, args.messages, span_days=args.days, topics=args.topics,
+                          authors=args.authors, text_size=args.text_size)
+    topics = {tid: f"Topic title {tid}" for tid in range(1, args.topics + 1)}
+    topics[0] = "General"
+    end = START + datetime.timedelta(days=args.days)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        store = MessageStore(os.path.join(workdir, "store.sqlite"))
+        t0 = time.perf_counter()
+        fill_store(store, history)
+        print(f"хранилище: {args.messages} сообщений за {time.perf_counter() - t0:.2f} c")
+        for fmt in args.formats:
+            for layout in (args.layouts if fmt == "xlsx" else [None]):
+                filename = os.path.join(workdir, f"out.{fmt}")
+                best = None
+                for _ in range(args.runs):
+                    t0 = time.perf_counter()
+                    phases = write_file(fmt, filename, store, 1, START, end, topics, datetime.timezone.utc,
+                                        layout=layout)
+                    elapsed = time.perf_counter() - t0
+                    if best is None or elapsed < best[0]:
+                        best = (elapsed, phases)
+                elapsed, phases = best
+                label = f"{fmt}/{layout}" if layout else fmt
+                detail = ", ".join(f"{name} {sec:.2f}" for name, sec in phases.items())
+                print(f"{label:12} {elapsed:.2f} c ({detail}) — {args.messages / elapsed:.0f} сообщ./с, "
+                      f"файл {os.path.getsize(filename) / 1024 / 1024:.1f} МБ, "
+                      f"пиковая память {core._peak_rss_mb()} МБ")
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
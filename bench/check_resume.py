@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Проверка продолжения прерванного экспорта на локальном фейке Telegram: экспорт обрывается
+после --fail-after страниц, затем продолжается с контрольной точки (resume) с другим числом частей,
+и CSV сравнивается с CSV экспорта без обрыва. Сценарии: параллельная загрузка продолжается
+последовательно и наоборот, а также период, уходящий в будущее (разбиение зависит от «сейчас»).
+Код завершения 1, если хоть один файл отличается.
+
+    python bench/check_resume.py --messages 20000 --fail-after 100
+"""
+
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import core
+from fake_telegram import FakeHistory, FakeTelegramClient
+
+START = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+# (параллельных частей до обрыва, при продолжении, период уходит в будущее)
+SCENARIOS = [
+    (4, 1, False),
+    (4, 4, False),
+    (4, 2, False),
+    (1, 4, False),
+    (4, 1, True),
+]
+
+
+def export(history, start, end, shards, resume=False, fail_after=0):
+    """(результат export_messages_range, сколько сообщений прочитано у фейка)."""
+    # задержка запросов нужна, чтобы части читались вперемешку, как с настоящим Telegram
+    fake = FakeTelegramClient(history, latency=0.001, fail_after=fail_after)
+    core.set_client_factory(lambda *a, **kw: fake)
+    try:
+        res = core.export_messages_range(0, "", core.SESSION_NAME, None, 1, start, end, log_callback=lambda s: None,
+                                         formats=["csv"], shards=shards, resume=resume, search_index=False)
+    finally:
+        core.set_client_factory(None)
+    return res, fake.fetched
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    parser.add_argument("--messages", type=int, default=20000, help="сообщений в периоде")
+    parser.add_argument("--days", type=int, default=30, help="длина периода в днях")
+    parser.add_argument("--fail-after", type=int, default=100, help="обрыв после стольких страниц истории (всего)")
+    args = parser.parse_args()
+
+    ok = True
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)  # контрольные точки пишутся в текущую папку
+        try:
+            for first, then, future in SCENARIOS:
+                start = START
+                if future:
+                    start = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+                    start -= datetime.timedelta(days=args.days)
+                end = start + datetime.timedelta(days=args.days + (10 if future else 0))
+                history = FakeHistory(start, args.messages, span_days=args.days)
+                reference, _ = export(history, start, end, 1)
+                expected = read(reference["filename"])
+                os.remove(reference["filename"])
+
+                failed, _ = export(history, start, end, first, fail_after=args.fail_after)
+                resumed, fetched = export(history, start, end, then, resume=True)
+                same = bool(resumed.get("success")) and read(resumed["filename"]) == expected
+                ok = ok and same and not failed.get("success")
+                label = f"{first} -> {then}" + (", до будущего" if future else "")
+                print(f"{label:22} обрыв: {failed.get('message', 'нет')}; после продолжения сообщений "
+                      f"{resumed.get('count')}, загружено заново {fetched} — {'OK' if same else 'ОТЛИЧАЕТСЯ'}")
+                os.remove(resumed["filename"])
+        finally:
+            os.chdir(cwd)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
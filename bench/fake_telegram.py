@@ -0,0 +1,311 @@
+"""
+Локальная подмена TelegramClient для бенчмарков без сети.
+История чата генерируется лениво по номеру сообщения, поэтому сама подмена
+почти не занимает памяти и не искажает замеры экспортёра.
+"""
+
+import asyncio
+import datetime
+import math
+from types import SimpleNamespace
+
+from telethon.errors import FloodWaitError
+from telethon.tl.types import (Chat, ChatPhotoEmpty, MessageMediaDocument, MessageMediaPhoto)
+
+_LOREM = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt "
+          "ut labore et dolore magna aliqua ut enim ad minim veniam quis nostrud exercitation ") * 64
+
+
+class FakeSender(SimpleNamespace):
+    pass
+
+
+class GetUsersRequest:
+    """Проверка авторизации при start (get_me)."""
+
+
+class GetHistoryRequest:
+    """Страница истории чата (имя как у запроса Telegram — так она видна в замерах)."""
+
+
+class GetRepliesRequest:
+    """Страница ветки топика."""
+
+
+class GetDialogsRequest:
+    """Страница списка диалогов."""
+
+
+class GetFileRequest:
+    """Загрузка вложения."""
+
+
+class FakeMessage:
+    __slots__ = ("id", "date", "message", "reply_to", "sender", "sender_id", "input_sender", "media", "file")
+
+    def __init__(self, msg_id, date, text, sender, reply_to=None, in_page=True, media=None, ext=None):
+        self.id = msg_id
+        self.media = media
+        self.file = SimpleNamespace(ext=ext) if media is not None else None
+        self.date = date
+        self.message = text
+        self.reply_to = reply_to
+        # отправитель, не пришедший вместе со страницей, резолвится отдельным запросом
+        self.sender = sender if in_page else None
+        self.sender_id = sender.id if sender else None
+        self.input_sender = sender.id if sender else None
+
+    async def get_sender(self):
+        return FakeSender(id=self.sender_id, first_name=f"User{self.sender_id - 1000}",
+                          last_name=None, username=f"user{self.sender_id - 1000}")
+
+
+class FakeHistory:
+    """
+    Синтетическая история: count сообщений, равномерно распределённых по span_days дням
+    начиная со start. Топик, автор и длина текста детерминированно выводятся из номера.
+    topics — число топиков форума (0 — обычный чат), authors — число разных авторов,
+    text_size — средняя длина текста, unresolved — доля сообщений без отправителя в странице.
+    media — доля сообщений с вложением (фото или документ); треть из них без текста,
+    а id файлов повторяются примерно у каждого второго вложения, как у пересланных.
+    """
+
+    def __init__(self, start, count, span_days=30, topics=0, authors=50, text_size=80, seed=1, unresolved=0.0,
+                 media=0.0):
+        self.start = start
+        self.count = count
+        self.step = datetime.timedelta(days=span_days) / max(count, 1)
+        self.topics = topics
+        self.text_size = text_size
+        self.seed = seed
+        self.unresolved = unresolved
+        self.media = media
+        self.media_files = max(int(count * media / 2), 1)
+        self.senders = [
+            FakeSender(id=1000 + i, first_name=f"User{i}", last_name=None, username=f"user{i}")
+            for i in range(authors)
+        ]
+        self._topic_refs = {
+            tid: SimpleNamespace(forum_topic=True, reply_to_top_id=tid, reply_to_msg_id=tid)
+            for tid in range(1, topics + 1)
+        }
+
+    def _hash(self, i):
+        return (i * 2654435761 + self.seed * 40503) & 0xFFFFFFFF
+
+    def topic_of(self, i):
+        return self._hash(i) % (self.topics + 1) if self.topics else 0
+
+    def message(self, i):
+        h = self._hash(i)
+        tid = self.topic_of(i)
+        n = max(1, self.text_size // 2 + (h >> 16) % (self.text_size + 1))
+        off = (h >> 8) % 512
+        text = _LOREM[off:off + n]
+        media = ext = None
+        if (h >> 4) % 1000 < self.media * 1000:
+            file_id = 10 ** 12 + (h >> 2) % self.media_files
+            if file_id % 2:
+                media, ext = MessageMediaPhoto(photo=SimpleNamespace(id=file_id)), ".jpg"
+            else:
+                media, ext = MessageMediaDocument(document=SimpleNamespace(id=file_id)), ".pdf"
+            if h % 3 == 0:
+                text = ""
+        return FakeMessage(
+            i + 1, self.start + self.step * i, text,
+            self.senders[(h >> 8) % len(self.senders)], self._topic_refs.get(tid),
+            in_page=(h % 1000) >= self.unresolved * 1000, media=media, ext=ext,
+        )
+
+    def index_after_date(self, date):
+        """Номер первого сообщения строго позже date."""
+        k = math.floor((date - self.start) / self.step) + 1
+        return min(max(k, 0), self.count)
+
+    def last_in_topic(self, tid):
+        for i in range(self.count - 1, -1, -1):
+            if self.topic_of(i) == tid:
+                return self.message(i)
+        return None
+
+
+class FakeTelegramClient:
+    """
+    Минимальный набор методов TelegramClient, который использует core:
+    start, connect, disconnect, is_connected, get_entity, __call__/_call (топики форума), iter_messages
+    и download_media (пишет media_size байт).
+    """
+
+    def __init__(self, history, chat_title="Fake chat", latency=0.0, flood_every=0, drop_every=0, dialogs=0,
+                 media_size=4096, fail_after=0):
+        self.history = history
+        self.chat_title = chat_title
+        self.topics = {tid: f"Topic title {tid}" for tid in range(1, history.topics + 1)}
+        self.latency = latency          # задержка на один запрос
+        self.flood_every = flood_every  # каждый N-й запрос страницы отвечает FloodWait на 1 с
+        self.drop_every = drop_every    # каждый N-й запрос страницы рвёт соединение
+        self.fail_after = fail_after    # после N запросов страниц экспорт обрывается неустранимой ошибкой
+        self.connected = False
+        self.drops = 0
+        self.starts = 0
+        # список диалогов по убыванию активности: каждый третий — личный чат (не попадает в список чатов)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.dialogs = [
+            SimpleNamespace(
+                id=-(100000 + i), name=f"Dialog {i}", pinned=False, date=now - datetime.timedelta(minutes=i),
+                entity=SimpleNamespace() if i % 3 == 2 else
+                Chat(100000 + i, f"Dialog {i}", ChatPhotoEmpty(), 10, now, 1),
+            )
+            for i in range(dialogs)
+        ]
+        self.fetched = 0
+        self.pages = 0
+        self.requests = 0
+        self.downloads = 0
+        self.media_size = media_size
+        self.flood_sleep_threshold = 60
+
+    async def start(self, phone=None):
+        # как у TelegramClient: start подключается и проверяет авторизацию запросом,
+        # поэтому он засчитывается в запросы экспорта
+        self.starts += 1
+        self.connected = True
+        await self._call(None, GetUsersRequest())
+        return self
+
+    async def connect(self):
+        self.connected = True
+
+    async def disconnect(self):
+        self.connected = False
+
+    def is_connected(self):
+        return self.connected
+
+    async def get_entity(self, entity):
+        if isinstance(entity, list):
+            await self._call(None, SimpleNamespace())
+            by_id = {s.id: s for s in self.history.senders}
+            return [by_id.get(x) for x in entity]
+        return SimpleNamespace(id=entity, title=self.chat_title, forum=bool(self.topics))
+
+    async def _call(self, sender, request, *args, **kwargs):
+        """Как у TelegramClient: через _call проходят все запросы (его оборачивает инструментирование core)."""
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if not self.connected:
+            raise ConnectionError("Cannot send requests while disconnected")
+        if isinstance(request, (GetHistoryRequest, GetRepliesRequest)):
+            self.pages += 1
+            if self.fail_after and self.pages > self.fail_after:
+                raise RuntimeError("Fake hard failure")
+            if self.drop_every and self.pages % self.drop_every == 0:
+                self.drops += 1
+                self.connected = False
+                raise ConnectionError("Connection to Telegram failed 5 time(s)")
+            if self.flood_every and self.pages % self.flood_every == 0:
+                raise FloodWaitError(request=None, capture=1)
+            return None
+        if hasattr(request, "channel"):
+            return self._topics_response(request)
+        return None
+
+    async def __call__(self, request):
+        return await self._call(None, request)
+
+    def _topics_response(self, request):
+        """GetForumTopicsRequest (постранично, по убыванию активности) и GetForumTopicsByIDRequest."""
+        epoch = SimpleNamespace(id=0, date=datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc))
+
+        def topic(tid):
+            top = self.history.last_in_topic(tid) or epoch
+            return SimpleNamespace(id=tid, title=self.topics[tid], top_message=top.id, pinned=False), top
+
+        if hasattr(request, "topics"):
+            found = [topic(tid) for tid in request.topics if tid in self.topics]
+            return SimpleNamespace(topics=[t for t, _ in found], messages=[m for _, m in found])
+
+        ordered = sorted((topic(tid) for tid in self.topics), key=lambda tm: (tm[1].date, tm[0].id), reverse=True)
+        if request.offset_date is not None:
+            key = (request.offset_date, request.offset_topic)
+            ordered = [tm for tm in ordered if (tm[1].date, tm[0].id) < key]
+        page = ordered[:request.limit]
+        return SimpleNamespace(topics=[t for t, _ in page], messages=[m for _, m in page])
+
+    async def download_media(self, msg, file=None):
+        await self._call(None, GetFileRequest())
+        self.downloads += 1
+        with open(file, "wb") as f:
+            f.write(msg.media.__class__.__name__.encode() * (self.media_size // 16 + 1))
+        return file
+
+    def touch_dialog(self, i, name=None):
+        """Новое сообщение (и, возможно, новое название) в диалоге i: он поднимается наверх списка."""
+        dialog = self.dialogs.pop(i)
+        dialog.date = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=1)
+        if name is not None:
+            dialog.name = name
+        self.dialogs.insert(0, dialog)
+
+    async def get_dialogs(self, limit=None):
+        await self._call(None, GetDialogsRequest())
+        return SimpleNamespace(total=len(self.dialogs))
+
+    def iter_dialogs(self):
+        return _FakeDialogIter(self)
+
+    def iter_messages(self, chat, offset_date=None, offset_id=0, reverse=False, reply_to=None, **kwargs):
+        if not reverse:
+            raise NotImplementedError("FakeTelegramClient поддерживает только reverse=True")
+        # как и RequestIter в Telethon — обычный объект, а не async-генератор:
+        # его можно бросить на середине без предупреждений о незакрытой задаче
+        return _FakeIter(self, offset_date, offset_id, reply_to)
+
+
+class _FakeIter:
+    def __init__(self, client, offset_date, offset_id, reply_to):
+        h = client.history
+        i = h.index_after_date(offset_date) if offset_date is not None else 0
+        if offset_id:
+            i = max(i, offset_id)  # id = номер + 1
+        self.client = client
+        self.reply_to = reply_to
+        self.k = i
+        self.n = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        client, h = self.client, self.client.history
+        while self.k < h.count:
+            k = self.k
+            self.k += 1
+            if self.reply_to is not None and h.topic_of(k) != self.reply_to:
+                continue
+            if self.n % 100 == 0:
+                await client._call(None, GetHistoryRequest() if self.reply_to is None else GetRepliesRequest())
+            self.n += 1
+            client.fetched += 1
+            return h.message(k)
+        raise StopAsyncIteration
+
+
+class _FakeDialogIter:
+    """Как и _FakeIter — объект, а не async-генератор: core бросает листание на середине."""
+
+    def __init__(self, client):
+        self.client = client
+        self.i = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.i >= len(self.client.dialogs):
+            raise StopAsyncIteration
+        if self.i % 100 == 0:
+            await self.client._call(None, GetDialogsRequest())
+        self.i += 1
+        return self.client.dialogs[self.i - 1]
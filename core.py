@@ -4,43 +4,67 @@ Core logic for Telegram Chat Exporter
 """
 
 import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
 import datetime
+import json
 import os
+import queue
 import re
-from openpyxl import Workbook
-from telethon import TelegramClient
-from telethon.tl.functions.channels import GetForumTopicsRequest
-from telethon.tl.types import User, Chat, Channel
-from dotenv import load_dotenv, set_key, dotenv_values
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from types import SimpleNamespace
+from storage import MessageStore, SearchIndex, write_raw_dump, read_raw_dump
+from writers import check_formats, write_file, write_job
 
 # --- Версия программы ---
 PROGRAM_NAME = "Telegram Chat Exporter"
 PROGRAM_VERSION = "v1.1"
 
 SESSION_NAME = "tg_session"
+CACHE_FILE = "tg_cache.sqlite"
+SEARCH_FILE = "tg_search.sqlite"
 
 # --- Работа с .env ---
 ENV_FILE = ".env"
+ENV_KEYS = ("API_ID", "API_HASH", "PHONE", "YEAR_DEFAULT", "MONTH_DEFAULT")
+_settings = None
+
+
+def get_settings(reload=False):
+    """
+    Параметры программы {ключ из ENV_KEYS: строка}: читаются из окружения и .env один раз за запуск,
+    дальше отдаются из памяти. Переменная окружения важнее значения в .env; reload — перечитать.
+    """
+    global _settings
+    if _settings is None or reload:
+        cfg = {}
+        if os.path.exists(ENV_FILE):
+            from dotenv import dotenv_values
+            cfg = dotenv_values(ENV_FILE)
+        _settings = {key: os.getenv(key) or cfg.get(key) or "" for key in ENV_KEYS}
+    return _settings
 
 
 def load_env_vars():
-    """Загружает переменные окружения из .env и возвращает словарь."""
-    load_dotenv(ENV_FILE)
-    cfg = dotenv_values(ENV_FILE)
-    return {
-        "API_ID": os.getenv("API_ID") or cfg.get("API_ID", ""),
-        "API_HASH": os.getenv("API_HASH") or cfg.get("API_HASH", ""),
-        "PHONE": os.getenv("PHONE") or cfg.get("PHONE", ""),
-        "YEAR_DEFAULT": os.getenv("YEAR_DEFAULT") or cfg.get("YEAR_DEFAULT", ""),
-        "MONTH_DEFAULT": os.getenv("MONTH_DEFAULT") or cfg.get("MONTH_DEFAULT", ""),
-    }
+    """Параметры из окружения и .env (копия get_settings)."""
+    return dict(get_settings())
 
 
 def save_env_vars(api_id, api_hash, phone, year=None, month=None):
-    """Сохраняет переменные окружения в .env."""
+    """Сохраняет переменные окружения в .env и в get_settings."""
+    from dotenv import set_key
+    settings = get_settings()
+
     def _set(k, v):
         if v:
             set_key(ENV_FILE, k, str(v))
+            settings[k] = os.getenv(k) or str(v)
 
     _set("API_ID", api_id)
     _set("API_HASH", api_hash)
@@ -56,7 +80,7 @@ def check_env_vars(required=("API_ID", "API_HASH", "PHONE")):
     Проверяет наличие обязательных параметров в окружении (.env).
     Возвращает (ok: bool, missing: list).
     """
-    env = load_env_vars()
+    env = get_settings()
     missing = [key for key in required if not env.get(key)]
     return (len(missing) == 0, missing)
 
@@ -68,6 +92,45 @@ def _safe_filename(s: str) -> str:
     return re.sub(r'[\\/*?:"<>|]', "_", s)
 
 
+# --- telethon ---
+# импорт telethon занимает заметную часть запуска программы, поэтому он откладывается
+# до первого подключения или разбора ответа Telegram (окно и --help открываются без него)
+_tl = None
+
+
+def _telethon():
+    """Нужные классы telethon (импортируются при первом вызове)."""
+    global _tl
+    if _tl is None:
+        from telethon import TelegramClient
+        from telethon.errors import FloodWaitError, ServerError, TimedOutError
+        from telethon.tl.functions.channels import GetForumTopicsRequest, GetForumTopicsByIDRequest
+        from telethon.tl.types import Chat, Channel, MessageMediaPhoto, MessageMediaDocument
+        _tl = SimpleNamespace(
+            TelegramClient=TelegramClient, FloodWaitError=FloodWaitError,
+            GetForumTopicsRequest=GetForumTopicsRequest, GetForumTopicsByIDRequest=GetForumTopicsByIDRequest,
+            Chat=Chat, Channel=Channel, MessageMediaPhoto=MessageMediaPhoto, MessageMediaDocument=MessageMediaDocument,
+            # сетевые сбои, после которых чтение продолжается с переподключением, а не обрывает экспорт
+            RETRY_ERRORS=(ConnectionError, OSError, asyncio.TimeoutError, ServerError, TimedOutError),
+            # только сбои связи, без локальных OSError (нет места, нет прав на запись файла)
+            NETWORK_ERRORS=(ConnectionError, asyncio.TimeoutError, ServerError, TimedOutError),
+        )
+    return _tl
+
+
+# Фабрика клиента: по умолчанию TelegramClient; бенчмарки подменяют её локальным фейком
+_client_factory = None
+
+
+def set_client_factory(factory):
+    """
+    Подменяет класс клиента, создаваемого create_telegram_client: factory(session_name, api_id, api_hash).
+    None возвращает TelegramClient.
+    """
+    global _client_factory
+    _client_factory = factory
+
+
 def create_telegram_client(api_id, api_hash, session_name, log_callback=None):
     """
     Создает экземпляр TelegramClient с новым event loop (для потоков).
@@ -80,7 +143,7 @@ def create_telegram_client(api_id, api_hash, session_name, log_callback=None):
     except Exception:
         raise ValueError("API_ID должен быть числом")
 
-    client = TelegramClient(session_name, api_id, api_hash)
+    client = (_client_factory or _telethon().TelegramClient)(session_name, api_id, api_hash)
 
     # Устанавливаем loop для клиента вручную
     loop = asyncio.new_event_loop()
@@ -91,21 +154,57 @@ def create_telegram_client(api_id, api_hash, session_name, log_callback=None):
 
 
 # ----------------- LIST CHATS -----------------
-async def _list_chats_async(client, phone, log_callback):
+async def _load_dialogs(client, cache, log_callback, full=False):
+    """
+    Список групп и каналов [(name, id)]. Диалоги Telegram отдаёт по убыванию активности,
+    поэтому с кэшем листаются только диалоги новее сохранённой активности (новое сообщение
+    или переименование поднимают чат наверх), а остальные берутся из кэша.
+    Если изменилось общее число диалогов (вход в чат или выход из него) или full — листаются все.
+    """
+    cached, last_activity, total = cache.load_dialogs() if cache is not None else (None, None, None)
+    if cache is not None:
+        current_total = (await client.get_dialogs(limit=0)).total
+        if cached is not None and not full and current_total != total:
+            log_callback("Число диалогов изменилось, обновляю список целиком...")
+            cached = None
+        total = current_total
+    if full:
+        cached = None
+
+    fresh = []
+    newest = 0 if cached is None else last_activity
+    count = 0
+    tl = _telethon()
+    group_types = (tl.Chat, tl.Channel)
+    async for dialog in client.iter_dialogs():
+        activity = int(dialog.date.timestamp()) if dialog.date else 0
+        if cached is not None and activity < last_activity and not dialog.pinned:
+            break
+        count += 1
+        newest = max(newest, activity)
+        if isinstance(dialog.entity, group_types):
+            fresh.append((dialog.id, getattr(dialog, "name", str(dialog.entity)), activity))
+
+    if cache is None:
+        return [(name, cid) for cid, name, _ in fresh]
+    cache.save_dialogs(fresh, newest, total, replace=cached is None)
+    log_callback(f"Обновлено из Telegram диалогов: {count}.")
+    return cache.load_dialogs()[0]
+
+
+async def _list_chats_async(client, phone, log_callback, full=False):
     chats = []
+    cache = open_cache(log_callback=log_callback)
     try:
         log_callback("Подключение к Telegram для получения списка чатов...")
         await client.start(phone=phone)
         log_callback("Подключение установлено. Получаю список чатов...")
-        async for dialog in client.iter_dialogs():
-            entity = dialog.entity
-            if isinstance(entity, (Chat, Channel)):
-                name = getattr(dialog, "name", str(entity))
-                cid = dialog.id
-                chats.append((name, cid))
+        chats = await _load_dialogs(client, cache, log_callback, full)
         log_callback(f"Найдено {len(chats)} чатов.")
         return chats
     finally:
+        if cache is not None:
+            cache.close()
         try:
             await client.disconnect()
             log_callback("Отключился от Telegram (list_chats).")
@@ -113,15 +212,18 @@ async def _list_chats_async(client, phone, log_callback):
             pass
 
 
-def list_chats(api_id, api_hash, session_name, phone, log_callback=None):
-    """Синхронная функция. Возвращает список [(name, id), ...]."""
+def list_chats(api_id, api_hash, session_name, phone, log_callback=None, full=False):
+    """
+    Синхронная функция. Возвращает список [(name, id), ...].
+    Список кэшируется в CACHE_FILE и обновляется инкрементально; full — перечитать все диалоги.
+    """
     if log_callback is None:
         log_callback = lambda s: print(s)
 
     client = create_telegram_client(api_id, api_hash, session_name, log_callback)
     loop = client._loop
     try:
-        return loop.run_until_complete(_list_chats_async(client, phone, log_callback))
+        return loop.run_until_complete(_list_chats_async(client, phone, log_callback, full))
     except Exception as e:
         log_callback(f"Ошибка при получении списка чатов: {e}")
         return []
@@ -132,152 +234,1841 @@ def list_chats(api_id, api_hash, session_name, phone, log_callback=None):
             pass
 
 
+def cached_chats():
+    """Список чатов [(name, id)] из локального кэша без подключения к Telegram; [] — если его нет."""
+    if not os.path.exists(CACHE_FILE):
+        return []
+    cache = open_cache()
+    if cache is None:
+        return []
+    try:
+        return cache.load_dialogs()[0] or []
+    finally:
+        cache.close()
+
+
+def resolve_chat_refs(refs, chats):
+    """
+    ID чатов по ссылкам из командной строки: число — это ID, иначе точное название чата
+    из chats [(name, id)] без учёта регистра. Возвращает (ids, errors): errors — ссылки,
+    для которых чат не найден или найдено несколько чатов с таким названием.
+    """
+    by_name = {}
+    for name, cid in chats:
+        by_name.setdefault(name.casefold(), []).append(cid)
+    ids, errors = [], []
+    for ref in refs:
+        ref = str(ref).strip()
+        if re.fullmatch(r"-?\d+", ref):
+            ids.append(int(ref))
+            continue
+        found = by_name.get(ref.casefold(), [])
+        if len(found) == 1:
+            ids.append(found[0])
+        elif found:
+            errors.append(f"{ref}: несколько чатов с таким названием ({', '.join(map(str, found))}), укажите ID")
+        else:
+            errors.append(f"{ref}: чат не найден")
+    return ids, errors
+
+
+# ----------------- INSTRUMENTATION -----------------
+# ExportStats текущей задачи экспорта: параллельные задачи пакета делят один клиент,
+# и запросы/паузы приписываются задаче через контекст asyncio
+_current_stats = contextvars.ContextVar("tg_export_stats", default=None)
+
+
+def _peak_rss_mb():
+    """Пиковый RSS процесса (и дочерних процессов пула) в МБ, если платформа позволяет его узнать."""
+    try:
+        import resource
+        scale = 1 if sys.platform == "darwin" else 1024  # macOS отдаёт байты, Linux — КБ
+        peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        return round(peak * scale / 1024 / 1024, 1)
+    except Exception:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return round(getattr(info, "peak_wset", info.rss) / 1024 / 1024, 1)
+    except Exception:
+        return None
+
+
+class ExportStats:
+    """
+    Замеры одного экспорта: время по фазам, скорость чтения, число запросов к Telegram
+    (по типам), FloodWait-паузы, переподключения после сбоев и пиковая память.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = OrderedDict()
+        self.messages = 0
+        self.requests = Counter()
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0.0
+        self.retries = 0
+        self.media = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - t0)
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count_request(self, request):
+        self.requests[type(request).__name__] += 1
+
+    def as_dict(self):
+        fetch = self.phases.get("fetch", 0.0)
+        return {
+            "total_seconds": round(time.perf_counter() - self.started, 3),
+            "phases": {name: round(sec, 3) for name, sec in self.phases.items()},
+            "messages": self.messages,
+            "messages_per_sec": round(self.messages / fetch, 1) if fetch else None,
+            "requests": sum(self.requests.values()),
+            "requests_by_type": dict(self.requests),
+            "flood_waits": self.flood_waits,
+            "flood_wait_seconds": round(self.flood_wait_seconds, 1),
+            "retries": self.retries,
+            "media": self.media,
+            "peak_rss_mb": _peak_rss_mb(),
+        }
+
+    def summary_line(self):
+        d = self.as_dict()
+        phases = ", ".join(f"{name} {sec:.2f} c" for name, sec in d["phases"].items())
+        speed = f"{d['messages_per_sec']} сообщ./с" if d["messages_per_sec"] else "—"
+        return (f"Замеры: {phases}; всего {d['total_seconds']:.2f} c; скорость чтения {speed}; "
+                f"запросов {d['requests']}; FloodWait {d['flood_waits']} ({d['flood_wait_seconds']} c); "
+                f"переподключений {d['retries']}; "
+                f"пиковая память {d['peak_rss_mb']} МБ.")
+
+
+def _instrument_client(client):
+    """
+    Оборачивает низкоуровневый вызов клиента, чтобы каждый запрос к Telegram
+    засчитывался в ExportStats текущей задачи. Повторный вызов ничего не делает.
+    """
+    call = getattr(client, "_call", None)
+    if call is None or getattr(call, "_tg_export_counted", False):
+        return
+
+    async def counted_call(sender, request, *args, **kwargs):
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.count_request(request)
+        return await call(sender, request, *args, **kwargs)
+
+    counted_call._tg_export_counted = True
+    client._call = counted_call
+
+
+# ----------------- RATE LIMIT -----------------
+class FloodGate:
+    """
+    Общий ограничитель запросов для всех задач одного клиента.
+    Выдерживает минимальный интервал между страницами истории, а после FloodWait
+    любой задачи приостанавливает все задачи до окончания требуемой паузы.
+    """
+
+    def __init__(self, min_interval=0.0, log_callback=None):
+        self.min_interval = min_interval
+        self.log_callback = log_callback or (lambda s: None)
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self.flood_waits = 0
+        self.flood_seconds = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        slot = max(now, self._next_slot, self._paused_until)
+        self._next_slot = slot + self.min_interval
+        if slot > now:
+            stats = _current_stats.get()
+            if stats is not None and self._paused_until > now:
+                stats.flood_wait_seconds += self._paused_until - now
+            await asyncio.sleep(slot - now)
+
+    def penalize(self, seconds):
+        self.flood_waits += 1
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.flood_waits += 1
+        until = time.monotonic() + seconds
+        if until > self._paused_until:
+            self.flood_seconds += until - max(self._paused_until, time.monotonic())
+            self._paused_until = until
+            self.log_callback(f"FloodWait: Telegram просит подождать {seconds} с, все задачи на паузе.")
+
+
+RETRY_ATTEMPTS = 6         # подряд неудачных попыток без единого прочитанного сообщения
+RETRY_BASE_DELAY = 2.0     # пауза перед первой попыткой, далее удваивается
+RETRY_MAX_DELAY = 120.0
+
+
+async def _reconnect(client, attempt, error, log_callback):
+    """
+    Пауза с экспоненциальным ростом и переподключение клиента после сетевого сбоя.
+    Если попытки исчерпаны — пробрасывает error (прогресс остаётся в контрольной точке).
+    """
+    if attempt > RETRY_ATTEMPTS:
+        raise error
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.retries += 1
+    delay = min(RETRY_BASE_DELAY * 2 ** (attempt - 1), RETRY_MAX_DELAY)
+    log_callback(f"Сбой соединения ({type(error).__name__}: {error}). "
+                 f"Попытка {attempt}/{RETRY_ATTEMPTS} через {delay:.0f} с...")
+    await asyncio.sleep(delay)
+    try:
+        if not client.is_connected():
+            await client.connect()
+    except _telethon().RETRY_ERRORS as e:
+        log_callback(f"Переподключиться не удалось: {e}")
+
+
+async def _gated(gate, fn, *args, **kwargs):
+    """Вызывает await fn(...); при FloodWait ставит на паузу весь gate и повторяет."""
+    while True:
+        if gate is not None:
+            await gate.wait()
+        try:
+            return await fn(*args, **kwargs)
+        except _telethon().FloodWaitError as e:
+            if gate is None:
+                raise
+            gate.penalize(e.seconds)
+
+
+# ----------------- SENDERS -----------------
+PAGE_SIZE = 100          # столько сообщений Telegram отдаёт за один запрос GetHistory
+SENDER_CACHE_SIZE = 10000
+CHECKPOINT_PAGES = 20    # каждые столько страниц загруженное фиксируется на диске
+
+
+def _format_author(sender):
+    """Строка автора вида «Имя Фамилия (@username)»; «?» если отправитель неизвестен."""
+    author = ""
+    if sender and getattr(sender, "first_name", None):
+        author = f"{(sender.first_name or '')}".strip()
+    if sender and getattr(sender, "last_name", None):
+        author += f" {(sender.last_name or '')}"
+    if sender and getattr(sender, "username", None):
+        author += f" (@{sender.username})"
+    return author.strip() or "?"
+
+
+class SenderResolver:
+    """
+    Резолвит авторов сообщений пачками, по sender_id.
+    Отправители берутся из users/chats, пришедших вместе со страницей истории (msg.sender);
+    в сеть уходит один запрос на страницу только для тех, кого там не оказалось.
+    Отформатированные строки хранятся в ограниченном LRU-кэше.
+    """
+
+    def __init__(self, client, maxsize=SENDER_CACHE_SIZE, gate=None):
+        self.client = client
+        self.gate = gate
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+        self.seconds = 0.0
+
+    def _get(self, sender_id):
+        author = self._cache.get(sender_id)
+        if author is not None:
+            self._cache.move_to_end(sender_id)
+        return author
+
+    def _put(self, sender_id, author):
+        self._cache[sender_id] = author
+        self._cache.move_to_end(sender_id)
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    async def _fetch(self, messages):
+        """Один запрос на всех неизвестных отправителей страницы; при ошибке — по одному."""
+        self.requests += 1
+        try:
+            entities = await _gated(self.gate, self.client.get_entity, [msg.input_sender for msg in messages])
+            return dict(zip((msg.sender_id for msg in messages), entities))
+        except Exception:
+            pass
+        result = {}
+        for msg in messages:
+            self.requests += 1
+            try:
+                result[msg.sender_id] = await _gated(self.gate, msg.get_sender)
+            except Exception:
+                result[msg.sender_id] = None
+        return result
+
+    async def resolve_page(self, messages):
+        """Возвращает список строк авторов в порядке messages."""
+        authors = [None] * len(messages)
+        unresolved = {}
+        for i, msg in enumerate(messages):
+            sender_id = getattr(msg, "sender_id", None)
+            if sender_id is None:
+                authors[i] = _format_author(getattr(msg, "sender", None))
+                continue
+            author = self._get(sender_id)
+            if author is not None:
+                self.hits += 1
+                authors[i] = author
+                continue
+            self.misses += 1
+            sender = getattr(msg, "sender", None)
+            if sender is not None:
+                author = _format_author(sender)
+                self._put(sender_id, author)
+                authors[i] = author
+            elif getattr(msg, "input_sender", None) is not None:
+                unresolved.setdefault(sender_id, msg)
+            else:
+                authors[i] = "?"
+
+        if unresolved:
+            t0 = time.perf_counter()
+            fetched = await self._fetch(list(unresolved.values()))
+            self.seconds += time.perf_counter() - t0
+            for sender_id, sender in fetched.items():
+                self._put(sender_id, _format_author(sender))
+            for i, msg in enumerate(messages):
+                if authors[i] is None:
+                    authors[i] = self._get(msg.sender_id) or "?"
+        return authors
+
+    def stats_line(self):
+        return (f"Авторы: попаданий в кэш {self.hits}, промахов {self.misses}, "
+                f"запросов к сети {self.requests}.")
+
+
+# ----------------- OUTPUT -----------------
+# форматы файлов экспорта — ключи writers.WRITERS
+DEFAULT_FORMATS = ("xlsx",)
+
+
+def _normalize_formats(formats, layout=None):
+    """Список форматов без повторов; ValueError — неизвестный формат, раскладка xlsx или нет нужного пакета."""
+    formats = list(dict.fromkeys(fmt.lower().lstrip(".") for fmt in (formats or DEFAULT_FORMATS)))
+    check_formats(formats, layout)
+    return formats
+
+
+def parse_tz(s):
+    """
+    Часовой пояс для дат в отчёте: "" / "local" — локальный, "UTC", смещение "+03:00" / "-5",
+    или имя IANA ("Europe/Moscow"), если доступен zoneinfo.
+    """
+    if not s or s.lower() == "local":
+        return None
+    if s.upper() == "UTC":
+        return datetime.timezone.utc
+    m = re.fullmatch(r"(?:UTC)?([+-])(\d{1,2})(?::?(\d{2}))?", s, re.IGNORECASE)
+    if m:
+        delta = datetime.timedelta(hours=int(m.group(2)), minutes=int(m.group(3) or 0))
+        return datetime.timezone(-delta if m.group(1) == "-" else delta)
+    try:
+        from zoneinfo import ZoneInfo
+        return ZoneInfo(s)
+    except Exception:
+        raise ValueError(f"Неизвестный часовой пояс: {s}")
+
+
+# ----------------- RAW DUMP / OFFLINE RENDER -----------------
+def _export_basename(chat_title, start_date, end_date, output_dir=None, topic_ids=None, chat_id=None):
+    """
+    Имя файла экспорта без расширения: tg_messages_<чат>[_<chat_id>]_<период>[_topics_<id>-<id>...].
+    chat_id добавляется в пакетном экспорте: у разных чатов бывают одинаковые названия.
+    """
+    name = f"tg_messages_{_safe_filename(chat_title)}"
+    if chat_id is not None:
+        name += f"_{chat_id}"
+    name += f"_{_period_label(start_date, end_date)}"
+    if topic_ids is not None:
+        name += "_topics_" + "-".join(str(tid) for tid in sorted(topic_ids))
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+        name = os.path.join(output_dir, name)
+    return name
+
+
+def dump_raw(path, store, chat_id, chat_title, start_date, end_date, topics, topic_ids=None, name_chat_id=False):
+    """
+    Пишет сырой дамп (gzip JSONL) сообщений чата за период из store.
+    name_chat_id — файлы экспорта названы с chat_id (пакет): render_dump называет их так же.
+    """
+    header = {
+        "chat_id": chat_id,
+        "title": chat_title,
+        "start": start_date.isoformat(),
+        "end": end_date.isoformat(),
+        "topics": [[tid, tname] for tid, tname in topics.items()],
+        "topic_ids": sorted(topic_ids) if topic_ids is not None else None,
+        "name_chat_id": name_chat_id,
+    }
+    start_ts, end_ts = int(start_date.timestamp()), int(end_date.timestamp())
+    write_raw_dump(path, header, store.iter_messages(chat_id, start_ts, end_ts, topic_ids))
+
+
+def render_dump(path, output_dir=None, tz=None, formats=None, layout=None):
+    """
+    Строит файлы (по умолчанию xlsx) из сырого дампа без подключения к Telegram.
+    formats — форматы из writers.WRITERS; layout — раскладка xlsx (writers.XLSX_LAYOUTS).
+    Возвращает словарь результата как export_messages.
+    """
+    try:
+        formats = _normalize_formats(formats, layout)
+        header, rows = read_raw_dump(path)
+    except Exception as e:
+        return {"success": False, "dump": path, "message": f"Не удалось прочитать дамп: {e}"}
+
+    chat_id = header["chat_id"]
+    start_date = datetime.datetime.fromisoformat(header["start"])
+    end_date = datetime.datetime.fromisoformat(header["end"])
+    topics = {tid: tname for tid, tname in header["topics"]}
+    basename = _export_basename(header["title"], start_date, end_date, output_dir or os.path.dirname(path),
+                                header.get("topic_ids"), chat_id if header.get("name_chat_id") else None)
+    files = [os.path.abspath(f"{basename}.{fmt}") for fmt in formats]
+
+    store = MessageStore.temporary_store()
+    try:
+        store.add_messages(chat_id, rows)
+        store.commit()
+        count = store.count(chat_id, int(start_date.timestamp()), int(end_date.timestamp()))
+        for fmt, filename in zip(formats, files):
+            write_file(fmt, filename, store, chat_id, start_date, end_date, topics, tz, layout=layout)
+    except Exception as e:
+        return {"success": False, "dump": path, "message": f"Ошибка при построении файла: {e}"}
+    finally:
+        store.close()
+    return {"success": True, "dump": path, "filename": files[0], "files": files, "count": count}
+
+
+def render_dumps(paths, output_dir=None, tz=None, workers=1, log_callback=None, formats=None, layout=None):
+    """Перестраивает файлы из нескольких дампов, при workers > 1 — параллельно в пуле процессов."""
+    if log_callback is None:
+        log_callback = lambda s: print(s)
+
+    results = []
+    if workers > 1 and len(paths) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(render_dump, p, output_dir, tz, formats, layout) for p in paths]
+            for fut in futures:
+                results.append(fut.result())
+                _log_render(results[-1], log_callback)
+    else:
+        for p in paths:
+            results.append(render_dump(p, output_dir, tz, formats, layout))
+            _log_render(results[-1], log_callback)
+    return results
+
+
+def _log_render(res, log_callback):
+    if res.get("success"):
+        log_callback(f"Файл сохранён: {', '.join(res['files'])} (сообщений: {res['count']})")
+    else:
+        log_callback(f"{res['dump']}: {res['message']}")
+
+
+# ----------------- TOPICS -----------------
+TOPICS_PAGE_SIZE = 100
+
+
+async def _iter_forum_topics(client, chat, gate):
+    """
+    Все топики форума постранично, в порядке последней активности (закреплённые — первыми).
+    Отдаёт (topic, last_activity_ts).
+    """
+    offset_date, offset_id, offset_topic = None, 0, 0
+    while True:
+        resp = await _gated(gate, client, _telethon().GetForumTopicsRequest(
+            channel=chat,
+            offset_date=offset_date,
+            offset_id=offset_id,
+            offset_topic=offset_topic,
+            limit=TOPICS_PAGE_SIZE,
+            q=None
+        ))
+        dates = {m.id: m.date for m in resp.messages}
+        # ForumTopicDeleted не имеет названия
+        page = [t for t in resp.topics if getattr(t, "title", None) is not None]
+        for topic in page:
+            activity = dates.get(topic.top_message)
+            yield topic, int(activity.timestamp()) if activity else 0
+        if len(resp.topics) < TOPICS_PAGE_SIZE or not page:
+            return
+        last = page[-1]
+        offset_date, offset_id, offset_topic = dates.get(last.top_message), last.top_message, last.id
+
+
+async def _load_topics(client, chat, chat_id, cache, gate, log_callback):
+    """
+    Список топиков {topic_id: title} с General (0) в конце.
+    С кэшем листаются только топики с активностью новее сохранённой: переименование
+    или новое сообщение поднимают топик наверх списка, остальные берутся из кэша.
+    """
+    if not getattr(chat, "forum", False):
+        if cache is not None:
+            cache.save_topics(chat_id, {}, 0)
+        return {0: "General"}
+
+    cached, last_activity = cache.load_topics(chat_id) if cache is not None else (None, None)
+    log_callback("Обновление списка топиков..." if cached is not None else "Получение списка топиков...")
+    fresh = {}
+    newest = last_activity or 0
+    pages = _iter_forum_topics(client, chat, gate)
+    try:
+        async for topic, activity in pages:
+            if cached is not None and activity < last_activity and not getattr(topic, "pinned", False):
+                break
+            fresh[topic.id] = topic.title
+            newest = max(newest, activity)
+        # генератор брошен на середине — закрываем явно, пока event loop ещё жив
+        await pages.aclose()
+    except Exception as e:
+        log_callback(f"Не удалось получить топики: {e}")
+        if cached is None:
+            return {0: "General"}
+
+    topics = dict(fresh)
+    for tid, tname in (cached or {}).items():
+        topics.setdefault(tid, tname)
+    if cache is not None:
+        cache.save_topics(chat_id, topics, newest)
+    log_callback(f"Топиков: {len(topics)} (обновлено из Telegram: {len(fresh)})")
+    topics[0] = "General"
+    return topics
+
+
+async def _resolve_missing_topics(client, chat, chat_id, topic_ids, topics, cache, gate, log_callback):
+    """Дозапрашивает названия топиков, встреченных в сообщениях, но отсутствующих в списке."""
+    missing = [tid for tid in topic_ids if tid not in topics]
+    if not missing or chat is None or not getattr(chat, "forum", False):
+        return
+    log_callback(f"Запрос названий для {len(missing)} неизвестных топиков...")
+    try:
+        for i in range(0, len(missing), TOPICS_PAGE_SIZE):
+            resp = await _gated(gate, client, _telethon().GetForumTopicsByIDRequest(
+                channel=chat, topics=missing[i:i + TOPICS_PAGE_SIZE]
+            ))
+            for topic in resp.topics:
+                if getattr(topic, "title", None) is not None:
+                    topics[topic.id] = topic.title
+    except Exception as e:
+        log_callback(f"Не удалось получить названия топиков: {e}")
+        return
+    if cache is not None:
+        known, last_activity = cache.load_topics(chat_id)
+        known = dict(known or {})
+        known.update((tid, tname) for tid, tname in topics.items() if tid != 0)
+        cache.save_topics(chat_id, known, last_activity or 0)
+
+
+# ----------------- MEDIA -----------------
+MEDIA_DIR = "media"
+MEDIA_WORKERS = 4
+
+
+def _media_file(msg):
+    """
+    (вид, id файла в Telegram, расширение) вложения сообщения или None, если скачивать нечего
+    (нет вложения, превью ссылки, опрос, геометка...). id не меняется при пересылке,
+    поэтому по нему одно и то же вложение узнаётся в разных сообщениях и чатах.
+    """
+    media = getattr(msg, "media", None)
+    if media is None:
+        return None
+    tl = _telethon()
+    if isinstance(media, tl.MessageMediaPhoto) and media.photo is not None:
+        kind, file_id = "photo", media.photo.id
+    elif isinstance(media, tl.MessageMediaDocument) and media.document is not None:
+        kind, file_id = "doc", media.document.id
+    else:
+        return None
+    ext = getattr(getattr(msg, "file", None), "ext", None) or ""
+    return kind, file_id, ext
+
+
+class MediaDownloader:
+    """
+    Скачивает вложения в папку MEDIA_DIR рядом с файлами экспорта (output_dir) пулом из workers
+    задач, параллельно с чтением сообщений. Файл называется по id в Telegram
+    (media/<xx>/<вид>_<id><ext>, xx — младший байт id), поэтому уже
+    скачанные при прошлых экспортах и повторённые в пересланных сообщениях вложения
+    не скачиваются повторно. Очередь ограничена: если загрузка отстаёт, submit ждёт,
+    и чтение истории не убегает вперёд, накапливая сообщения в памяти.
+    inflight — общий для параллельных заданий пакета словарь {полный путь: Future}: файл,
+    который сейчас качает другое задание, не скачивается второй раз — flush дожидается той загрузки.
+    """
+
+    def __init__(self, client, output_dir=None, workers=MEDIA_WORKERS, gate=None, log_callback=None,
+                 inflight=None):
+        self.client = client
+        self.output_dir = output_dir or "."
+        self.gate = gate
+        self.log_callback = log_callback or (lambda s: None)
+        self.queue = asyncio.Queue(maxsize=workers * 4)
+        self.inflight = {} if inflight is None else inflight
+        self.own = {}  # {relpath: Future} — загрузки, которые в inflight поставил этот загрузчик
+        self.waiting = []
+        self.seen = set()
+        self.failed = []
+        self.failed_paths = set()
+        self.reported = 0
+        self.downloaded = 0
+        self.reused = 0
+        self.bytes = 0
+        self.workers = [asyncio.ensure_future(self._worker()) for _ in range(workers)]
+
+    def relpath(self, msg):
+        """Путь вложения относительно папки экспорта или None, если у сообщения нет файла."""
+        found = _media_file(msg)
+        if found is None:
+            return None
+        kind, file_id, ext = found
+        return f"{MEDIA_DIR}/{file_id & 0xff:02x}/{kind}_{file_id}{ext}"
+
+    async def submit(self, msg):
+        """
+        Ставит вложение msg в очередь загрузки и сразу возвращает его будущий путь (relpath);
+        None — у сообщения нет файла или этот файл уже не удалось скачать.
+        """
+        path = self.relpath(msg)
+        if path is None or path in self.failed_paths:
+            return None
+        if path in self.seen:
+            return path
+        self.seen.add(path)
+        full = self._full(path)
+        pending = self.inflight.get(full)
+        if pending is not None:
+            # файл качает другое задание: ждём его в flush, а не скачиваем ещё раз
+            self.waiting.append((path, pending))
+        elif os.path.exists(full):
+            self.reused += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.inflight[full] = self.own[path] = future
+            try:
+                await self.queue.put((msg, path))
+            except BaseException:
+                # в очередь не попало — иначе другое задание ждало бы этот файл вечно
+                self._release(path, False)
+                raise
+        return path
+
+    def _full(self, path):
+        return os.path.join(self.output_dir, *path.split("/"))
+
+    def _release(self, path, ok):
+        """Снимает файл из inflight и сообщает ждущим заданиям, скачан ли он."""
+        future = self.own.pop(path, None)
+        if future is None:
+            return
+        full = self._full(path)
+        if self.inflight.get(full) is future:
+            del self.inflight[full]
+        if not future.done():
+            future.set_result(ok)
+
+    def _fail(self, path):
+        self.failed.append(path)
+        self.failed_paths.add(path)
+
+    async def _worker(self):
+        while True:
+            msg, path = await self.queue.get()
+            ok = False
+            try:
+                ok = await self._download(msg, path)
+            finally:
+                self._release(path, ok)
+                self.queue.task_done()
+
+    async def _download(self, msg, path):
+        """Скачивает вложение msg в path; False — не удалось."""
+        full = self._full(path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        # во временный .part со своим именем: оборванная загрузка не выглядит как готовый файл
+        # при следующем экспорте, а параллельные загрузки не пишут в один файл
+        tmp = f"{full}.{uuid.uuid4().hex[:8]}.part"
+        attempt = 0
+        while True:
+            try:
+                written = await _gated(self.gate, self.client.download_media, msg, file=tmp)
+                if not written:
+                    raise ValueError("Telegram не вернул файл")
+                os.replace(written, full)
+                self.downloaded += 1
+                self.bytes += os.path.getsize(full)
+                return True
+            except asyncio.CancelledError:
+                raise
+            except _telethon().NETWORK_ERRORS as e:
+                # ошибки диска не лечатся переподключением: такой файл сразу считается нескачанным
+                attempt += 1
+                if attempt <= RETRY_ATTEMPTS:
+                    await _reconnect(self.client, attempt, e, self.log_callback)
+                    continue
+                error = e
+            except Exception as e:
+                error = e
+            break
+        self._fail(path)
+        self.log_callback(f"Не удалось скачать вложение сообщения {msg.id}: {error}")
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        return False
+
+    async def flush(self):
+        """Ждёт, пока будет скачано всё, что уже поставлено в очередь, и файлы, которые качают другие задания."""
+        await self.queue.join()
+        if self.waiting:
+            waiting, self.waiting = self.waiting, []
+            # wait, а не gather: отмена этого задания не должна отменять чужие загрузки
+            await asyncio.wait({future for _, future in waiting})
+            for path, future in waiting:
+                if future.result():
+                    self.reused += 1
+                else:
+                    self._fail(path)
+
+    def new_failures(self):
+        """Пути, которые не удалось скачать с прошлого вызова: ссылки на них убираются из store перед коммитом."""
+        new = self.failed[self.reported:]
+        self.reported = len(self.failed)
+        return new
+
+    async def close(self):
+        """
+        Останавливает задачи пула; недокачанное из очереди отбрасывается (после flush очередь пуста).
+        Все загрузки этого загрузчика, которые ещё не завершены, отмечаются нескачанными,
+        чтобы их не ждали другие задания.
+        """
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        for path in list(self.own):
+            self._release(path, False)
+
+    def as_dict(self):
+        return {"downloaded": self.downloaded, "reused": self.reused, "failed": len(self.failed),
+                "bytes": self.bytes}
+
+    def stats_line(self):
+        return (f"Вложения: скачано {self.downloaded} ({self.bytes / 1024 / 1024:.1f} МБ), "
+                f"уже были на диске {self.reused}, ошибок {len(self.failed)}.")
+
+
 # ----------------- EXPORT MESSAGES -----------------
-async def _export_messages_async(client, phone, chat_id, year, month, log_callback):
+def _as_utc(dt):
+    """Наивные datetime считаются UTC; aware приводятся к UTC."""
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.astimezone(datetime.timezone.utc)
+
+
+def _from_ts(ts):
+    return datetime.datetime.fromtimestamp(ts, tz=datetime.timezone.utc)
+
+
+def month_range(year, month):
+    """Возвращает полуинтервал [start, end) месяца в UTC."""
+    start_date = datetime.datetime(year, month, 1, tzinfo=datetime.timezone.utc)
+    if month == 12:
+        end_date = datetime.datetime(year + 1, 1, 1, tzinfo=datetime.timezone.utc)
+    else:
+        end_date = datetime.datetime(year, month + 1, 1, tzinfo=datetime.timezone.utc)
+    return start_date, end_date
+
+
+def _period_label(start_date, end_date):
+    """Метка периода для имени файла: YYYY_MM для целого месяца, иначе YYYYMMDD_YYYYMMDD."""
+    if (start_date.day, start_date.hour, start_date.minute, start_date.second) == (1, 0, 0, 0) \
+            and month_range(start_date.year, start_date.month)[1] == end_date:
+        return f"{start_date.year}_{start_date.month:02d}"
+    return f"{start_date:%Y%m%d}_{end_date:%Y%m%d}"
+
+
+async def _iter_range(client, chat, start_date, end_date, gate=None, after_id=0, reply_to=None,
+                      log_callback=None):
+    """
+    Итерирует сообщения чата в полуинтервале [start_date, end_date) по возрастанию даты.
+    Останавливается на первом сообщении за верхней границей, не дочитывая историю до конца.
+    С gate каждая страница ждёт своей очереди, а FloodWait ставит на паузу все задачи
+    и чтение продолжается с последнего полученного сообщения.
+    after_id — читать только сообщения новее этого ID (инкрементальная догрузка);
+    reply_to — читать только ветку (топик форума) с этим ID на стороне сервера.
+    После сетевого сбоя клиент переподключается с растущей паузой (_reconnect)
+    и чтение тоже продолжается с последнего полученного сообщения.
+    """
+    if log_callback is None:
+        log_callback = lambda s: None
+    last_id = after_id
+    failures = 0
+    while True:
+        # offset_date у Telegram исключающий: отступаем на секунду, чтобы не потерять сообщение ровно в start_date
+        offset = {"offset_id": last_id} if last_id else {"offset_date": start_date - datetime.timedelta(seconds=1)}
+        try:
+            n = 0
+            if reply_to is not None:
+                offset["reply_to"] = reply_to
+            async for msg in client.iter_messages(chat, reverse=True, **offset):
+                if gate is not None and n % PAGE_SIZE == 0:
+                    await gate.wait()
+                n += 1
+                failures = 0
+                last_id = msg.id
+                if msg.date >= end_date:
+                    return
+                if msg.date < start_date:
+                    continue
+                yield msg
+            return
+        except _telethon().FloodWaitError as e:
+            if gate is None:
+                raise
+            gate.penalize(e.seconds)
+        except _telethon().RETRY_ERRORS as e:
+            failures += 1
+            await _reconnect(client, failures, e, log_callback)
+
+
+async def _iter_pages(messages, size):
+    """Группирует асинхронный поток сообщений в страницы по size штук."""
+    page = []
+    async for msg in messages:
+        page.append(msg)
+        if len(page) >= size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+def _topic_id(msg):
+    """ID топика форума, к которому относится сообщение; 0 — общий поток."""
+    if not msg.reply_to:
+        return 0
+    if not getattr(msg.reply_to, "forum_topic", False):
+        return 0
+    if getattr(msg.reply_to, "reply_to_top_id", None):
+        return msg.reply_to.reply_to_top_id
+    return getattr(msg.reply_to, "reply_to_msg_id", 0)
+
+
+async def _export_messages_async(client, phone, chat_id, year, month, log_callback, **options):
     try:
-        log_callback("Подключение к Telegram...")
-        await client.start(phone=phone)
-        log_callback("Подключение установлено.")
+        start_date, end_date = month_range(year, month)
+    except Exception as e:
+        return {"success": False, "message": f"Неверный год/месяц: {e}"}
+    return await _export_range_async(client, phone, chat_id, start_date, end_date, log_callback, **options)
+
+
+class _RangeProgress:
+    """
+    Доля загруженного периода [start_date, end_date) по дате последнего прочитанного сообщения
+    (период, уходящий в будущее, считается до текущего момента).
+    parts — сколько веток читается параллельно (топики, части периода): доля усредняется по ним.
+    callback(fraction) вызывается, только когда доля меняется на целый процент.
+    """
+
+    def __init__(self, start_date, end_date, callback):
+        self.start_ts, self.span = self._range(start_date, end_date)
+        self.callback = callback
+        self.parts = 1
+        self.done = {}
+        self.ranges = {}
+        self.percent = -1
+
+    @staticmethod
+    def _range(start_date, end_date):
+        start_ts = start_date.timestamp()
+        return start_ts, max(min(end_date.timestamp(), time.time()) - start_ts, 1)
+
+    def update(self, ts, part=None):
+        start_ts, span = self.ranges.get(part, (self.start_ts, self.span))
+        self.done[part] = min(max((ts - start_ts) / span, 0.0), 1.0)
+        self._report(min(sum(self.done.values()) / self.parts, 1.0))
 
+    def part(self, key, start_date, end_date):
+        """Прогресс части периода [start_date, end_date): её доля считается по её собственному интервалу."""
+        self.ranges[key] = self._range(start_date, end_date)
+        return _PartProgress(self, key)
+
+    def finish(self):
+        self._report(1.0)
+
+    def _report(self, fraction):
+        percent = int(fraction * 100)
+        if percent != self.percent:
+            self.percent = percent
+            self.callback(fraction)
+
+
+class _PartProgress:
+    """Прогресс одной части периода (см. _RangeProgress.part) с тем же интерфейсом update."""
+    __slots__ = ("progress", "key")
+
+    def __init__(self, progress, key):
+        self.progress = progress
+        self.key = key
+
+    def update(self, ts, part=None):
+        self.progress.update(ts, self.key)
+
+
+async def _fetch_into_store(client, chat, chat_id, store, start_date, end_date, resolver, gate, log_callback,
+                            after_id=0, topic_id=None, checkpoint=None, progress=None, media=None):
+    """
+    Загружает текстовые сообщения [start_date, end_date) (и с id > after_id, если задан)
+    в store страницами. С topic_id читается только ветка этого топика форума.
+    media — MediaDownloader: тогда сохраняются и сообщения только с вложением, а их файлы
+    ставятся в очередь загрузки; в store пишется путь к файлу. Перед каждым коммитом
+    дожидаемся очереди загрузок и убираем ссылки на файлы, которые скачать не удалось, —
+    в контрольную точку не попадают ссылки на нескачанные файлы.
+    Каждые CHECKPOINT_PAGES страниц store коммитится, после чего вызывается
+    checkpoint(date) с датой (unix) последнего прочитанного сообщения: всё до неё уже на диске.
+    progress — _RangeProgress, обновляется после каждой страницы.
+    Возвращает число загруженных сообщений.
+    """
+    total_messages = 0
+    pages = 0
+    messages = _iter_range(client, chat, start_date, end_date, gate, after_id=after_id, reply_to=topic_id,
+                           log_callback=log_callback)
+    async for page in _iter_pages(messages, PAGE_SIZE):
+        last_ts = int(page[-1].date.timestamp())
+        if media is None:
+            page = [msg for msg in page if msg.message]
+            paths = [None] * len(page)
+        else:
+            kept = [(msg, await media.submit(msg)) for msg in page]
+            kept = [(msg, path) for msg, path in kept if msg.message or path]
+            page, paths = [msg for msg, _ in kept], [path for _, path in kept]
+        authors = await resolver.resolve_page(page)
+        store.add_messages(chat_id, (
+            (msg.id, int(msg.date.timestamp()), _topic_id(msg) if topic_id is None else topic_id,
+             msg.sender_id, author, msg.message or "", path)
+            for msg, author, path in zip(page, authors, paths)
+        ))
+        if page:
+            total_messages += len(page)
+            prefix = f"Топик {topic_id}: п" if topic_id is not None else "П"
+            log_callback(f"{prefix}рочитано {total_messages} сообщений...")
+        pages += 1
+        if progress is not None:
+            progress.update(last_ts, topic_id)
+        if pages % CHECKPOINT_PAGES == 0:
+            if media is not None:
+                await media.flush()
+                store.clear_media(chat_id, media.new_failures())
+            store.commit()
+            if checkpoint is not None:
+                checkpoint(last_ts)
+    if media is not None:
+        await media.flush()
+        store.clear_media(chat_id, media.new_failures())
+    store.commit()
+    return total_messages
+
+
+async def _gather_parts(coros):
+    """
+    Как asyncio.gather для частей одной загрузки, но при первой ошибке (или отмене) остальные
+    части отменяются и дожидаются: после выхода ни одна из них уже не читает историю и не пишет
+    в store и очередь вложений, которые вызывающий закрывает.
+    """
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    if not tasks:
+        return []
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks)
+    for task in tasks:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+    return [task.result() for task in tasks]
+
+
+async def _fetch_topics_into_store(client, chat, chat_id, store, start_date, end_date, topic_ids, resolver, gate,
+                                   log_callback, progress=None, media=None):
+    """
+    Загружает только выбранные топики форума — каждый своим запросом ветки (reply_to),
+    параллельно. General (0) не является веткой: если он выбран, читается вся история,
+    а отбор делается локально. Если в store уже есть часть топика (контрольная точка),
+    догружаются только сообщения новее неё.
+    """
+    if 0 in topic_ids:
+        log_callback("General (0) нельзя запросить отдельной веткой — читаю всю историю за период.")
+        return await _fetch_into_store(client, chat, chat_id, store, start_date, end_date,
+                                       resolver, gate, log_callback, after_id=store.max_msg_id(chat_id),
+                                       progress=progress, media=media)
+    if progress is not None:
+        progress.parts = len(topic_ids)
+    counts = await _gather_parts(
+        _fetch_into_store(client, chat, chat_id, store, start_date, end_date, resolver, gate, log_callback,
+                          after_id=store.max_msg_id(chat_id, tid), topic_id=tid, progress=progress,
+                          media=media)
+        for tid in topic_ids
+    )
+    return sum(counts)
+
+
+def _shard_bounds(start_date, end_date, shards):
+    """
+    Границы частей периода для параллельного чтения: [start_date, end_date) режется на shards
+    равных по времени частей. Будущее не делится — последняя часть просто продолжается до end_date.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    split_end = min(end_date, max(now, start_date + datetime.timedelta(seconds=shards)))
+    step = (split_end - start_date) / shards
+    bounds = [start_date + step * k for k in range(shards)] + [end_date]
+    # границы округляются до секунды: даты сообщений в Telegram — целые секунды
+    bounds = [bounds[0]] + [b.replace(microsecond=0) for b in bounds[1:-1]] + [bounds[-1]]
+    return list(zip(bounds, bounds[1:]))
+
+
+async def _fetch_sharded(client, chat, chat_id, store, start_date, end_date, shards, resolver, gate, log_callback,
+                         progress=None, media=None):
+    """
+    Загружает период частями (_shard_bounds), каждую своим потоком запросов к истории, параллельно:
+    все части делят gate (FloodWait любой ставит на паузу все) и кэш авторов.
+    Сообщения сливаются в store по ключу (chat_id, msg_id), а файлы читают их упорядоченными
+    по msg_id, поэтому хронологический порядок и порядок внутри топиков те же, что при чтении подряд.
+    Разбиение сохраняется в store (save_parts). Если в store уже есть часть сообщений (контрольная точка),
+    загрузка продолжается теми же частями, что и в прошлый раз, каким бы ни было shards сейчас:
+    после параллельной загрузки в начале частей остаются пропуски, и продолжить её «после
+    последнего ID» нельзя. Каждая часть догружается с того места, где остановилась.
+    """
+    saved = store.load_parts(chat_id)
+    if saved:
+        parts = [(_from_ts(part_start), _from_ts(part_end)) for part_start, part_end in saved]
+        parts[0] = (start_date, parts[0][1])
+        parts[-1] = (parts[-1][0], end_date)
+        if len(parts) != shards:
+            log_callback(f"Контрольная точка загружалась {len(parts)} частями — продолжаю теми же частями.")
+    else:
+        parts = _shard_bounds(start_date, end_date, shards)
+        store.save_parts(chat_id, [(int(part_start.timestamp()), int(part_end.timestamp()))
+                                   for part_start, part_end in parts])
+    log_callback(f"Период разбит на {len(parts)} частей, загружаю параллельно...")
+    if progress is not None:
+        progress.parts = len(parts)
+
+    def part_log(k):
+        return lambda s: log_callback(f"Часть {k + 1}/{len(parts)}: {s}")
+
+    counts = await _gather_parts(
+        _fetch_into_store(client, chat, chat_id, store, part_start, part_end, resolver, gate, part_log(k),
+                          after_id=store.max_msg_id(chat_id, start_ts=int(part_start.timestamp()),
+                                                    end_ts=int(part_end.timestamp())),
+                          progress=progress.part(k, part_start, part_end) if progress is not None else None,
+                          media=media)
+        for k, (part_start, part_end) in enumerate(parts)
+    )
+    return sum(counts)
+
+
+async def _sync_cache(client, chat, chat_id, cache, start_date, end_date, resolver, gate, log_callback,
+                      progress=None):
+    """
+    Догружает в постоянный кэш то, чего в нём не хватает для [start_date, end_date):
+    историю раньше покрытого интервала и сообщения новее сохранённого max_id.
+    При чтении вперёд покрытие сдвигается на каждой контрольной точке, поэтому
+    после обрыва следующий запуск продолжает с места остановки.
+    Возвращает число сообщений, загруженных из Telegram.
+    """
+    start_ts, end_ts = int(start_date.timestamp()), int(end_date.timestamp())
+    # верхняя граница покрытия — момент начала загрузки: всё, что раньше, уже будет в истории
+    now_ts = int(time.time())
+    state = cache.get_sync(chat_id)
+    fetched = 0
+
+    def checkpoint(cov_start):
+        return lambda ts: cache.set_sync(chat_id, cov_start, ts, cache.max_msg_id(chat_id))
+
+    if state is None:
+        log_callback("Чата нет в локальном кэше, загружаю период целиком...")
+        fetched += await _fetch_into_store(client, chat, chat_id, cache, start_date, end_date,
+                                           resolver, gate, log_callback, checkpoint=checkpoint(start_ts),
+                                           progress=progress)
+        cov_start, cov_end = start_ts, min(end_ts, now_ts)
+    else:
+        cov_start, cov_end, max_id = state
+        if start_ts < cov_start:
+            log_callback("Догружаю в кэш более раннюю историю...")
+            fetched += await _fetch_into_store(client, chat, chat_id, cache, start_date, _from_ts(cov_start),
+                                               resolver, gate, log_callback, progress=progress)
+            cov_start = start_ts
+        if end_ts > cov_end:
+            log_callback(f"Догружаю в кэш сообщения новее ID {max_id}...")
+            fetched += await _fetch_into_store(client, chat, chat_id, cache, _from_ts(cov_end), end_date,
+                                               resolver, gate, log_callback, after_id=max_id,
+                                               checkpoint=checkpoint(cov_start), progress=progress)
+            cov_end = min(end_ts, now_ts)
+    cache.set_sync(chat_id, cov_start, cov_end, cache.max_msg_id(chat_id))
+    return fetched
+
+
+def _checkpoint_path(chat_id, start_date, end_date, output_dir=None, topic_ids=None, media=False):
+    """Файл контрольной точки экспорта; однозначно определяется чатом, периодом, выбором топиков и вложениями."""
+    name = f"tg_partial_{chat_id}_{_period_label(start_date, end_date)}"
+    if topic_ids is not None:
+        name += "_topics_" + "-".join(str(tid) for tid in sorted(topic_ids))
+    if media:
+        name += "_media"
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+        name = os.path.join(output_dir, name)
+    return name + ".sqlite"
+
+
+async def _export_chat_async(client, chat_id, start_date, end_date, log_callback, output_dir=None,
+                             stats=None, stats_json=False, **options):
+    """
+    Экспорт одного чата за [start_date, end_date) через уже подключённый клиент.
+    options (значения по умолчанию — в _export_chat_measured):
+    gate — общий FloodGate параллельных задач; executor — пул процессов для записи xlsx;
+    cache — постоянный MessageStore (названия чатов и топиков кэшируются в нём всегда);
+    use_cache — кэшировать в нём и сообщения: из Telegram догружается только недостающее,
+    а Excel строится из кэша; raw — рядом с xlsx сохранить сырой дамп .jsonl.gz
+    для последующего render_dump без подключения; topic_ids — экспортировать только эти
+    топики форума, загружая с сервера лишь их ветки; formats — форматы файлов из writers.WRITERS
+    (по умолчанию только xlsx), все пишутся из одной загрузки сообщений; layout — раскладка xlsx
+    (writers.XLSX_LAYOUTS: "table" — один лист с колонкой топика вместо копии на листах топиков).
+    Без кэша загруженное каждые CHECKPOINT_PAGES страниц фиксируется в файле контрольной точки
+    (_checkpoint_path), который удаляется после успеха; resume — продолжить с него, а не начинать заново.
+    progress_callback(fraction) — доля загруженного периода 0…1 (по датам сообщений), по целым процентам.
+    media — скачивать вложения (фото, документы, голосовые) в папку media рядом с файлами
+    (MediaDownloader) и сохранять сообщения без текста; в xlsx появляется колонка ссылок на файлы;
+    media_inflight — общий словарь загрузок параллельных заданий (MediaDownloader, inflight).
+    С media кэш сообщений не используется: в нём нет путей к вложениям.
+    index — SearchIndex: после записи файлов выгруженные сообщения добавляются в поисковый индекс.
+    shards — читать период столькими частями параллельно (_fetch_sharded); без кэша и выборки топиков.
+    Контрольная точка такой загрузки продолжается теми же частями, даже если resume запущен без shards.
+    name_chat_id — добавить chat_id в имя файлов (_export_basename), как в пакетном экспорте.
+    stats — ExportStats для замеров (создаётся, если не передан); замеры возвращаются
+    в result["stats"], а с stats_json ещё и пишутся в <файл>.stats.json рядом с файлами экспорта.
+    """
+    if stats is None:
+        stats = ExportStats()
+    _current_stats.set(stats)
+    result = await _export_chat_measured(client, chat_id, start_date, end_date, log_callback, output_dir, stats,
+                                         **options)
+    result["stats"] = stats.as_dict()
+    log_callback(stats.summary_line())
+    if stats_json and result.get("filename"):
+        stats_filename = os.path.splitext(result["filename"])[0] + ".stats.json"
+        with open(stats_filename, "w", encoding="utf-8") as f:
+            json.dump(dict(result["stats"], chat_id=int(chat_id), start=start_date.isoformat(),
+                           end=end_date.isoformat(), count=result.get("count")), f, ensure_ascii=False, indent=1)
+        result["stats_filename"] = stats_filename
+    return result
+
+
+async def _export_chat_measured(client, chat_id, start_date, end_date, log_callback, output_dir, stats,
+                                gate=None, executor=None, cache=None, use_cache=False, raw=False, topic_ids=None,
+                                formats=None, resume=False, progress_callback=None, media=False, index=None,
+                                shards=1, layout=None, media_inflight=None, name_chat_id=False):
+    try:
+        formats = _normalize_formats(formats, layout)
+    except ValueError as e:
+        return {"success": False, "message": str(e)}
+    chat_id = int(chat_id)
+    start_ts, end_ts = int(start_date.timestamp()), int(end_date.timestamp())
+    if cache is None:
+        use_cache = False
+    if topic_ids is not None:
+        topic_ids = sorted({int(tid) for tid in topic_ids})
+    if media and use_cache:
+        log_callback("С выгрузкой вложений кэш сообщений не используется: сообщения загружаются заново.")
+        use_cache = False
+
+    if use_cache and cache.covers(chat_id, start_ts, end_ts):
+        chat_title = cache.load_chat(chat_id)
+        topics = dict(cache.load_topics(chat_id)[0] or {})
+        topics[0] = "General"
+        log_callback(f"Чат: {chat_title}")
+        log_callback("Период полностью есть в локальном кэше, запросы к Telegram не нужны.")
+        chat = None
+    else:
         log_callback(f"Получение информации о чате (ID={chat_id})...")
         try:
-            chat = await client.get_entity(int(chat_id))
+            with stats.phase("chat_info"):
+                chat = await _gated(gate, client.get_entity, chat_id)
         except Exception as e:
             return {"success": False, "message": f"Не удалось найти чат {chat_id}: {e}"}
 
         chat_title = getattr(chat, "title", str(chat))
         log_callback(f"Чат: {chat_title}")
+        if cache is not None:
+            cache.save_chat(chat_id, chat_title)
+        with stats.phase("topics"):
+            topics = await _load_topics(client, chat, chat_id, cache, gate, log_callback)
 
-        # даты
-        try:
-            start_date = datetime.datetime(year, month, 1, tzinfo=datetime.timezone.utc)
-            if month == 12:
-                end_date = datetime.datetime(year + 1, 1, 1, tzinfo=datetime.timezone.utc) - datetime.timedelta(seconds=1)
+    # выборка топиков не обновляет покрытие кэша — она загружается в отдельное хранилище
+    if chat is not None and topic_ids is not None:
+        use_cache = False
+    if use_cache:
+        store = cache
+    else:
+        # без кэша сообщения копятся в файле контрольной точки: после сбоя он остаётся на диске
+        partial = _checkpoint_path(chat_id, start_date, end_date, output_dir, topic_ids, media)
+        if not resume:
+            MessageStore.remove(partial)
+        store = MessageStore(partial)
+        if resume and store.max_msg_id(chat_id):
+            log_callback(f"Продолжаю с контрольной точки: уже загружено {store.count(chat_id, start_ts, end_ts)} "
+                         f"сообщений, последний ID {store.max_msg_id(chat_id)}.")
+    progress = _RangeProgress(start_date, end_date, progress_callback) if progress_callback else None
+    downloader = None
+    completed = False
+    try:
+        if chat is not None:
+            resolver = SenderResolver(client, gate=gate)
+            if media:
+                downloader = MediaDownloader(client, output_dir, gate=gate, log_callback=log_callback,
+                                             inflight=media_inflight)
+            log_callback("Сбор сообщений...")
+            with stats.phase("fetch"):
+                if topic_ids is not None:
+                    if shards > 1:
+                        log_callback("С выборкой топиков shards не учитывается: топики и так читаются параллельно.")
+                    stats.messages = await _fetch_topics_into_store(client, chat, chat_id, store, start_date,
+                                                                    end_date, topic_ids, resolver, gate, log_callback,
+                                                                    progress, downloader)
+                elif use_cache:
+                    if shards > 1:
+                        log_callback("С кэшем сообщений период читается одним потоком.")
+                    stats.messages = await _sync_cache(client, chat, chat_id, cache, start_date, end_date,
+                                                       resolver, gate, log_callback, progress)
+                    log_callback(f"Из Telegram загружено новых сообщений: {stats.messages}.")
+                elif shards > 1 or store.load_parts(chat_id):
+                    # и без shards: контрольную точку параллельной загрузки продолжаем по частям
+                    stats.messages = await _fetch_sharded(client, chat, chat_id, store, start_date, end_date,
+                                                          shards, resolver, gate, log_callback, progress, downloader)
+                else:
+                    stats.messages = await _fetch_into_store(client, chat, chat_id, store, start_date, end_date,
+                                                             resolver, gate, log_callback,
+                                                             after_id=store.max_msg_id(chat_id), progress=progress,
+                                                             media=downloader)
+            # время сетевых запросов авторов входит и в fetch
+            stats.add_phase("senders", resolver.seconds)
+            log_callback(resolver.stats_line())
+            if downloader is not None:
+                # загрузки дожидаются в fetch, поэтому их время входит в эту фазу
+                await downloader.flush()
+                store.clear_media(chat_id, downloader.new_failures())
+                stats.media = downloader.as_dict()
+                log_callback(downloader.stats_line())
+            with stats.phase("topics"):
+                await _resolve_missing_topics(client, chat, chat_id,
+                                              store.topic_counts(chat_id, start_ts, end_ts, topic_ids),
+                                              topics, cache, gate, log_callback)
+        if progress is not None:
+            progress.finish()
+
+        total_messages = store.count(chat_id, start_ts, end_ts, topic_ids)
+        if total_messages == 0:
+            completed = True
+            log_callback("Сообщений за выбранный период не найдено.")
+            return {"success": False, "empty": True, "message": "Сообщений за выбранный период нет."}
+
+        log_callback(f"Найдено {total_messages} сообщений. Подготовка файлов...")
+
+        basename = _export_basename(chat_title, start_date, end_date, output_dir, topic_ids,
+                                    chat_id if name_chat_id else None)
+        files = [os.path.abspath(f"{basename}.{fmt}") for fmt in formats]
+        if raw:
+            raw_filename = os.path.abspath(basename + ".jsonl.gz")
+            log_callback("Запись сырого дампа...")
+            with stats.phase("raw_dump"):
+                dump_raw(raw_filename, store, chat_id, chat_title, start_date, end_date, topics, topic_ids,
+                         name_chat_id)
+            log_callback(f"Сырой дамп сохранён: {raw_filename}")
+        log_callback(f"Запись файлов: {', '.join(formats)}...")
+        if executor is None:
+            timings = [write_file(fmt, filename, store, chat_id, start_date, end_date, topics, topic_ids=topic_ids,
+                                  layout=layout)
+                       for fmt, filename in zip(formats, files)]
+        else:
+            # форматы пишутся параллельно, каждый в своём процессе
+            loop = asyncio.get_running_loop()
+            timings = await asyncio.gather(*(
+                loop.run_in_executor(executor, write_job, fmt, filename, store.path, chat_id,
+                                     start_date, end_date, topics, None, topic_ids, layout)
+                for fmt, filename in zip(formats, files)
+            ))
+        for phases in timings:
+            for name, sec in phases.items():
+                stats.add_phase(name, sec)
+        if index is not None:
+            with stats.phase("index"):
+                _update_index(index, store, chat_id, chat_title, start_date, end_date, topics, topic_ids,
+                              log_callback)
+        completed = True
+    finally:
+        if downloader is not None:
+            await downloader.close()
+        if store is not cache:
+            store.close()
+            if completed:
+                MessageStore.remove(partial)
             else:
-                end_date = datetime.datetime(year, month + 1, 1, tzinfo=datetime.timezone.utc) - datetime.timedelta(seconds=1)
-        except Exception as e:
-            return {"success": False, "message": f"Неверный год/месяц: {e}"}
+                log_callback(f"Загруженные сообщения сохранены в контрольной точке {partial}. "
+                             f"Повторите экспорт с продолжением (resume), чтобы не загружать их заново.")
+    for filename in files:
+        log_callback(f"Файл сохранён: {filename}")
+
+    result = {"success": True, "filename": files[0], "files": files, "count": total_messages}
+    if raw:
+        result["raw_filename"] = raw_filename
+    return result
+
+
+def open_cache(path=None, log_callback=None):
+    """
+    Открывает постоянный локальный кэш (по умолчанию CACHE_FILE).
+    Если файл недоступен — пишет в лог и возвращает None: экспорт работает и без кэша.
+    """
+    try:
+        return MessageStore(path or CACHE_FILE)
+    except Exception as e:
+        if log_callback is not None:
+            log_callback(f"Локальный кэш недоступен: {e}")
+        return None
+
+
+def open_search_index(path=None, log_callback=None):
+    """
+    Открывает поисковый индекс (по умолчанию SEARCH_FILE). Если файл недоступен
+    или SQLite собран без FTS5 — пишет в лог и возвращает None: экспорт работает и без индекса.
+    """
+    try:
+        return SearchIndex(path or SEARCH_FILE)
+    except Exception as e:
+        if log_callback is not None:
+            log_callback(f"Поисковый индекс недоступен: {e}")
+        return None
+
+
+def _update_index(index, store, chat_id, chat_title, start_date, end_date, topics, topic_ids, log_callback):
+    """Добавляет текстовые сообщения периода в поисковый индекс; ошибка индекса не срывает экспорт."""
+    start_ts, end_ts = int(start_date.timestamp()), int(end_date.timestamp())
+    rows = ((msg_id, date, tid, topics.get(tid, f"Topic {tid}"), author, text)
+            for msg_id, date, tid, sender_id, author, text, media in store.iter_messages(chat_id, start_ts, end_ts,
+                                                                                       topic_ids)
+            if text)
+    try:
+        changed = index.add(chat_id, chat_title, rows)
+    except sqlite3.Error as e:
+        log_callback(f"Не удалось обновить поисковый индекс: {e}")
+        return
+    log_callback(f"Поисковый индекс обновлён: новых и изменённых сообщений {changed}.")
+
+
+def _cache_covers(chat_id, start_date, end_date, use_cache=False, media=False, **options):
+    """С use_cache: весь период уже есть в локальном кэше и экспорту не нужен Telegram (см. MessageStore.covers)."""
+    if not use_cache or media:
+        return False
+    cache = open_cache()
+    if cache is None:
+        return False
+    try:
+        return cache.covers(int(chat_id), int(start_date.timestamp()), int(end_date.timestamp()))
+    finally:
+        cache.close()
+
+
+async def _export_range_async(client, phone, chat_id, start_date, end_date, log_callback, **options):
+    """
+    Подключение, экспорт одного чата (_export_chat_async с options) и отключение.
+    Если период полностью есть в кэше (use_cache), клиент не подключается вовсе.
+    """
+    stats = ExportStats()
+    _current_stats.set(stats)
+    _instrument_client(client)
+    connected = False
+    try:
+        if not _cache_covers(chat_id, start_date, end_date, **options):
+            log_callback("Подключение к Telegram...")
+            with stats.phase("connect"):
+                connected = True
+                await client.start(phone=phone)
+            log_callback("Подключение установлено.")
+        return await _export_connected(client, chat_id, start_date, end_date, log_callback, stats, **options)
+
+    finally:
+        if connected:
+            try:
+                await client.disconnect()
+                log_callback("Отключение от Telegram.")
+            except Exception:
+                pass
+
+
+async def _export_connected(client, chat_id, start_date, end_date, log_callback, stats=None, search_index=True,
+                            **options):
+    """
+    Экспорт одного чата через уже подключённый клиент: с локальным кэшем и своим FloodGate.
+    search_index — обновить поисковый индекс SEARCH_FILE выгруженными сообщениями.
+    """
+    cache = open_cache(log_callback=log_callback)
+    index = open_search_index(log_callback=log_callback) if search_index else None
+    # FloodWait обрабатывает gate, чтобы паузы попали в замеры
+    flood_sleep_threshold = client.flood_sleep_threshold
+    client.flood_sleep_threshold = 0
+    try:
+        return await _export_chat_async(client, chat_id, start_date, end_date, log_callback,
+                                        gate=FloodGate(log_callback=log_callback), cache=cache, stats=stats,
+                                        index=index, **options)
+    finally:
+        client.flood_sleep_threshold = flood_sleep_threshold
+        if cache is not None:
+            cache.close()
+        if index is not None:
+            index.close()
+
+
+def export_messages(api_id, api_hash, session_name, phone, chat_id, year, month, log_callback=None, **options):
+    """
+    Синхронная обёртка для экспорта сообщений. options:
+    use_cache — хранить сообщения в локальном кэше CACHE_FILE и догружать только новые;
+    raw — сохранить рядом сырой дамп .jsonl.gz для перестроения файла без подключения;
+    topic_ids — экспортировать только эти топики форума (загружаются только их ветки);
+    stats_json — записать замеры (result["stats"]) в <файл>.stats.json рядом с xlsx;
+    formats — форматы файлов ("xlsx", "csv", "parquet"), по умолчанию только xlsx.
+    Путь первого файла — в result["filename"], всех — в result["files"];
+    resume — продолжить прерванный экспорт с контрольной точки, а не загружать всё заново;
+    progress_callback(fraction) — доля загруженного периода 0…1 (вызывается из потока экспорта);
+    media — скачать вложения в папку media рядом с файлами и добавить ссылки на них;
+    search_index — добавить выгруженные сообщения в поисковый индекс SEARCH_FILE (см. search_messages);
+    shards — читать период столькими частями параллельно (для очень больших чатов);
+    layout — раскладка xlsx: "sheets" (по умолчанию) или "table" — один лист с колонкой топика и автофильтром.
+    """
+    if log_callback is None:
+        log_callback = lambda s: print(s)
+
+    client = create_telegram_client(api_id, api_hash, session_name, log_callback)
+    loop = client._loop
+    try:
+        return loop.run_until_complete(
+            _export_messages_async(client, phone, chat_id, year, month, log_callback, **options)
+        )
+    except Exception as e:
+        log_callback(f"Исключение при экспорте: {e}")
+        return {"success": False, "message": f"Исключение: {e}"}
+    finally:
+        try:
+            loop.close()
+        except Exception:
+            pass
+
+
+def export_messages_range(api_id, api_hash, session_name, phone, chat_id, start_date, end_date, log_callback=None,
+                          **options):
+    """
+    Синхронная обёртка для экспорта сообщений за произвольный полуинтервал [start_date, end_date).
+    Наивные datetime считаются UTC. options — как в export_messages.
+    """
+    if log_callback is None:
+        log_callback = lambda s: print(s)
 
-        # топики
-        log_callback("Получение списка топиков (если есть)...")
+    start_date, end_date = _as_utc(start_date), _as_utc(end_date)
+    if start_date >= end_date:
+        return {"success": False, "message": "Начало периода должно быть раньше конца."}
+
+    client = create_telegram_client(api_id, api_hash, session_name, log_callback)
+    loop = client._loop
+    try:
+        return loop.run_until_complete(
+            _export_range_async(client, phone, chat_id, start_date, end_date, log_callback, **options)
+        )
+    except Exception as e:
+        log_callback(f"Исключение при экспорте: {e}")
+        return {"success": False, "message": f"Исключение: {e}"}
+    finally:
         try:
-            topics_resp = await client(GetForumTopicsRequest(
-                channel=chat,
-                offset_date=None,
-                offset_id=0,
-                offset_topic=0,
-                limit=200,
-                q=None
-            ))
-            topics = {t.id: t.title for t in topics_resp.topics}
-            log_callback(f"Топиков получено: {len(topics)}")
-        except Exception as e:
-            log_callback(f"Не удалось получить топики: {e}")
-            topics = {}
-        topics[0] = "General"
+            loop.close()
+        except Exception:
+            pass
 
-        messages_by_topic = {tid: [] for tid in topics.keys()}
-        total_messages = 0
-        log_counter = 0
 
-        log_callback("Сбор сообщений...")
-        async for msg in client.iter_messages(chat, offset_date=start_date, reverse=True):
-            if not msg.message:
-                continue
-            if not (start_date <= msg.date <= end_date):
-                continue
-            # определяем topic_id
-            if not msg.reply_to:
-                topic_id = 0
-            elif not getattr(msg.reply_to, "forum_topic", False):
-                topic_id = 0
-            elif getattr(msg.reply_to, "reply_to_top_id", None):
-                topic_id = msg.reply_to.reply_to_top_id
-            else:
-                topic_id = getattr(msg.reply_to, "reply_to_msg_id", 0)
-
-            sender = await msg.get_sender()
-            author = ""
-            if sender and getattr(sender, "first_name", None):
-                author = f"{(sender.first_name or '')}".strip()
-            if sender and getattr(sender, "last_name", None):
-                author += f" {(sender.last_name or '')}"
-            if sender and getattr(sender, "username", None):
-                author += f" (@{sender.username})"
-            author = author.strip()
-
-            messages_by_topic.setdefault(topic_id, []).append((author or "?", msg.date.astimezone(), msg.message))
-            total_messages += 1
-            log_counter += 1
-            if log_counter % 100 == 0:
-                log_callback(f"Прочитано {total_messages} сообщений...")
+# ----------------- BATCH EXPORT -----------------
+def split_by_month(start_date, end_date):
+    """Режет [start_date, end_date) по границам календарных месяцев UTC."""
+    parts = []
+    cur = start_date
+    while cur < end_date:
+        nxt = min(month_range(cur.year, cur.month)[1], end_date)
+        parts.append((cur, nxt))
+        cur = nxt
+    return parts
 
-        if total_messages == 0:
-            log_callback("Сообщений за выбранный период не найдено.")
-            return {"success": False, "message": "Сообщений за выбранный период нет."}
 
-        log_callback(f"Найдено {total_messages} сообщений. Подготовка Excel-файла...")
+def batch_jobs(chat_ids, start_date, end_date, per="month"):
+    """
+    Список заданий (chat_id, start, end): по одному на чат и месяц (per="month")
+    или по одному на чат за весь период (per="chat").
+    """
+    start_date, end_date = _as_utc(start_date), _as_utc(end_date)
+    if per == "month":
+        periods = split_by_month(start_date, end_date)
+    elif per == "chat":
+        periods = [(start_date, end_date)]
+    else:
+        raise ValueError(f"Неизвестный режим разбиения: {per}")
+    return [(int(cid), s, e) for cid in chat_ids for s, e in periods]
 
-        wb = Workbook()
-        default_sheet = wb.active
-        if default_sheet and default_sheet.title == "Sheet":
-            wb.remove(default_sheet)
 
-        ws_all = wb.create_sheet(title="Все сообщения")
-        ws_all.append(["Топик", "Автор", "Дата", "Сообщение"])
+def _job_key(chat_id, start_date, end_date):
+    return f"{chat_id}:{int(start_date.timestamp())}:{int(end_date.timestamp())}"
 
-        for tid, msgs in messages_by_topic.items():
-            tname = topics.get(tid, f"Topic {tid}")
-            for author, date_obj, text in msgs:
-                ws_all.append([tname, author, date_obj.strftime("%Y-%m-%d %H:%M"), text])
 
-        ws_list = wb.create_sheet(title="Список")
-        ws_list.append(["ID", "Топик", "Название листа", "Кол-во сообщений"])
-        for tid, msgs in messages_by_topic.items():
-            if not msgs:
-                continue
-            tname = topics.get(tid, f"Topic {tid}")
-            ws_list.append([tid, tname, tname[:31], len(msgs)])
-            ws_topic = wb.create_sheet(title=tname[:31])
-            ws_topic.append([tname])
-            ws_topic.append(["Автор", "Дата", "Сообщение"])
-            for author, date_obj, text in msgs:
-                ws_topic.append([author, date_obj.strftime("%Y-%m-%d %H:%M"), text])
-
-        safe_title = _safe_filename(chat_title)
-        filename = f"tg_messages_{safe_title}_{year}_{month:02d}.xlsx"
-        log_callback("Запись в файл Excel...")
-        wb.save(filename)
-        wb.close()
-        abs_path = os.path.abspath(filename)
-        log_callback(f"Файл сохранён: {abs_path}")
-
-        return {"success": True, "filename": abs_path, "count": total_messages}
+def _load_batch_state(state_file):
+    if not state_file or not os.path.exists(state_file):
+        return {}
+    try:
+        with open(state_file, encoding="utf-8") as f:
+            return json.load(f).get("done", {})
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_batch_state(state_file, done):
+    if not state_file:
+        return
+    tmp = state_file + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"done": done}, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, state_file)
+
+
+def _job_summary(chat_id, start_date, end_date, result):
+    summary = {
+        "chat_id": chat_id,
+        "start": start_date.isoformat(),
+        "end": end_date.isoformat(),
+    }
+    summary.update(result)
+    return summary
+
+
+async def _export_batch_async(client, phone, jobs, log_callback, output_dir=None, state_file=None,
+                              concurrency=1, min_interval=0.0, use_cache=False, search_index=True, **options):
+    """
+    Выполняет задания экспорта по одному подключению, до concurrency заданий одновременно.
+    Все задания делят один FloodGate: FloodWait любой задачи приостанавливает остальные.
+    При concurrency > 1 файлы пишутся в пуле процессов, не блокируя event loop.
+    Успешные и пустые задания записываются в state_file и при повторном запуске пропускаются.
+    search_index — обновлять поисковый индекс после каждого задания.
+    Остальные options передаются в _export_chat_async.
+    """
+    done = _load_batch_state(state_file)
+    cache = None
+    index = None
+    results = [None] * len(jobs)
+    gate = FloodGate(min_interval, log_callback)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    # с кэшем задания одного чата идут по очереди: каждое догружает историю после предыдущего
+    chat_locks = {chat_id: asyncio.Lock() for chat_id, _, _ in jobs}
+    executor = None
+    # одно вложение в нескольких чатах пакета скачивается одним заданием, остальные его дожидаются
+    media_inflight = {}
+
+    async def run_job(n, chat_id, start_date, end_date):
+        key = _job_key(chat_id, start_date, end_date)
+        title = f"[{n + 1}/{len(jobs)}] Чат {chat_id} {start_date:%Y-%m-%d}…{end_date:%Y-%m-%d}"
+        prev = done.get(key)
+        if prev is not None and (prev.get("empty") or os.path.exists(prev.get("filename", ""))):
+            log_callback(f"{title}: уже выполнено, пропуск.")
+            results[n] = _job_summary(chat_id, start_date, end_date, dict(prev, skipped=True))
+            return
+
+        async with (chat_locks[chat_id] if use_cache else asyncio.Lock()), semaphore:
+            log_callback(title)
+            job_log = log_callback if concurrency <= 1 else (lambda s: log_callback(f"[{chat_id}] {s}"))
+            try:
+                res = await _export_chat_async(client, chat_id, start_date, end_date, job_log, output_dir,
+                                               gate=gate, executor=executor, cache=cache, use_cache=use_cache,
+                                               index=index, media_inflight=media_inflight, name_chat_id=True,
+                                               **options)
+            except Exception as e:
+                job_log(f"Исключение при экспорте: {e}")
+                res = {"success": False, "message": f"Исключение: {e}"}
+        results[n] = _job_summary(chat_id, start_date, end_date, res)
+
+        if res.get("success") or res.get("empty"):
+            done[key] = res
+            _save_batch_state(state_file, done)
 
+    try:
+        cache = open_cache(log_callback=log_callback)
+        if search_index:
+            index = open_search_index(log_callback=log_callback)
+        _instrument_client(client)
+        log_callback("Подключение к Telegram...")
+        await client.start(phone=phone)
+        log_callback("Подключение установлено.")
+        # FloodWait обрабатывает общий gate, а не каждый запрос по отдельности
+        client.flood_sleep_threshold = 0
+
+        if concurrency > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=min(concurrency, os.cpu_count() or 1))
+        await asyncio.gather(*(run_job(n, *job) for n, job in enumerate(jobs)))
     finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+        if cache is not None:
+            cache.close()
+        if index is not None:
+            index.close()
         try:
             await client.disconnect()
             log_callback("Отключение от Telegram.")
         except Exception:
             pass
 
+    results = [r for r in results if r is not None]
+    ok = sum(1 for r in results if r.get("success"))
+    empty = sum(1 for r in results if r.get("empty"))
+    failed = len(results) - ok - empty
+    if gate.flood_waits:
+        log_callback(f"FloodWait: {gate.flood_waits} раз, суммарная пауза {gate.flood_seconds:.0f} с.")
+    log_callback(f"Итого заданий: {len(results)}; успешно {ok}, без сообщений {empty}, с ошибкой {failed}.")
+    return {"success": failed == 0 and len(results) == len(jobs), "jobs": results,
+            "ok": ok, "empty": empty, "failed": failed}
+
 
-def export_messages(api_id, api_hash, session_name, phone, chat_id, year, month, log_callback=None):
-    """Синхронная обёртка для экспорта сообщений."""
+def export_batch(api_id, api_hash, session_name, phone, chat_ids, start_date, end_date,
+                 per="month", output_dir=None, state_file=None, concurrency=1, log_callback=None, **options):
+    """
+    Синхронная обёртка пакетного экспорта: несколько чатов × период по одному подключению.
+    per="month" — файл на каждый чат и месяц, per="chat" — файл на чат за весь период.
+    state_file — JSON с выполненными заданиями для возобновления пакета.
+    concurrency — сколько заданий выполнять одновременно.
+    options — как в export_messages (кроме progress_callback);
+    вложения всех заданий складываются в одну папку media, поэтому общие файлы скачиваются один раз.
+    """
     if log_callback is None:
         log_callback = lambda s: print(s)
 
+    try:
+        jobs = batch_jobs(chat_ids, start_date, end_date, per)
+    except Exception as e:
+        return {"success": False, "message": f"Неверные параметры пакета: {e}", "jobs": []}
+    if not jobs:
+        return {"success": False, "message": "Нет заданий для экспорта.", "jobs": []}
+
     client = create_telegram_client(api_id, api_hash, session_name, log_callback)
     loop = client._loop
     try:
         return loop.run_until_complete(
-            _export_messages_async(client, phone, chat_id, year, month, log_callback)
+            _export_batch_async(client, phone, jobs, log_callback, output_dir, state_file, concurrency,
+                                **options)
         )
     except Exception as e:
-        log_callback(f"Исключение при экспорте: {e}")
-        return {"success": False, "message": f"Исключение: {e}"}
+        log_callback(f"Исключение при пакетном экспорте: {e}")
+        return {"success": False, "message": f"Исключение: {e}", "jobs": []}
     finally:
         try:
             loop.close()
         except Exception:
             pass
+
+
+# ----------------- SEARCH -----------------
+def search_messages(query, chat_ids=None, start_date=None, end_date=None, limit=50, by_date=False, path=None):
+    """
+    Поиск по индексу выгруженных сообщений без подключения к Telegram.
+    chat_ids, start_date/end_date — ограничить чатами и периодом [start_date, end_date) (наивные даты — UTC);
+    by_date — сначала новые, иначе сначала лучшие совпадения.
+    Возвращает {"success", "results": [{chat_id, chat, msg_id, date, topic, author, snippet}]} или "message".
+    """
+    path = path or SEARCH_FILE
+    if not query.strip():
+        return {"success": False, "message": "Пустой поисковый запрос."}
+    if not os.path.exists(path):
+        return {"success": False, "message": f"Поисковый индекс {path} ещё не создан: сначала выполните экспорт."}
+    try:
+        index = SearchIndex(path)
+    except sqlite3.Error as e:
+        return {"success": False, "message": f"Поисковый индекс недоступен: {e}"}
+    try:
+        rows = index.search(query, chat_ids,
+                            int(_as_utc(start_date).timestamp()) if start_date is not None else None,
+                            int(_as_utc(end_date).timestamp()) if end_date is not None else None,
+                            limit, by_date)
+    except sqlite3.Error as e:
+        return {"success": False, "message": f"Ошибка поиска: {e}"}
+    finally:
+        index.close()
+    results = [{"chat_id": chat_id, "chat": str(chat), "msg_id": msg_id, "date": _from_ts(date).isoformat(),
+                "topic": topic, "author": author, "snippet": snippet}
+               for chat_id, chat, msg_id, date, topic, author, snippet in rows]
+    return {"success": True, "results": results}
+
+
+# ----------------- BACKGROUND CLIENT -----------------
+class ProgressChannel:
+    """
+    Канал событий от экспорта к интерфейсу: строки лога, доля прогресса и вызовы,
+    которые нужно выполнить в потоке интерфейса. Писатели из любых потоков не блокируются
+    и не трогают виджеты; поток интерфейса забирает накопленное пачкой через drain() по таймеру.
+    """
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+
+    def log(self, text):
+        """Строка лога (подходит как log_callback)."""
+        self._queue.put(("log", (time.time(), text)))
+
+    def progress(self, fraction):
+        """Доля выполнения 0…1 (подходит как progress_callback)."""
+        self._queue.put(("progress", fraction))
+
+    def call(self, fn, *args):
+        """Выполнить fn(*args) в потоке интерфейса при следующем drain()."""
+        self._queue.put(("call", (fn, args)))
+
+    def drain(self, limit=10000):
+        """
+        Забирает до limit событий: ([(время, строка)], последняя доля прогресса или None, [(fn, args)]).
+        Из нескольких обновлений прогресса важно только последнее.
+        """
+        lines, fraction, calls = [], None, []
+        for _ in range(limit):
+            try:
+                kind, value = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "log":
+                lines.append(value)
+            elif kind == "progress":
+                fraction = value
+            else:
+                calls.append(value)
+        return lines, fraction, calls
+
+
+class ClientWorker:
+    """
+    Фоновый поток со своим event loop и одним TelegramClient на всё время работы программы (GUI).
+    Клиент подключается при первой задаче и остаётся подключённым для следующих; при смене
+    параметров авторизации он пересоздаётся. Методы возвращают concurrent.futures.Future.
+    """
+
+    def __init__(self, session_name=SESSION_NAME):
+        self.session_name = session_name
+        self.loop = asyncio.new_event_loop()
+        self.client = None
+        self._auth = None
+        self._thread = threading.Thread(target=self._run, name="telegram-client", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """Запускает корутину в потоке клиента."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def _connected(self, api_id, api_hash, phone, log_callback):
+        """Подключённый клиент для этих параметров авторизации (создаётся при первом вызове)."""
+        auth = (str(api_id), api_hash, phone)
+        if self.client is not None and auth != self._auth:
+            await self._disconnect(log_callback)
+        if self.client is None:
+            try:
+                api_id = int(api_id)
+            except Exception:
+                raise ValueError("API_ID должен быть числом")
+            client = (_client_factory or _telethon().TelegramClient)(self.session_name, api_id, api_hash)
+            _instrument_client(client)
+            log_callback("Подключение к Telegram...")
+            try:
+                await client.start(phone=phone)
+            except Exception:
+                await client.disconnect()
+                raise
+            log_callback("Подключение установлено.")
+            self.client, self._auth = client, auth
+        elif not self.client.is_connected():
+            log_callback("Переподключение к Telegram...")
+            await self.client.connect()
+        return self.client
+
+    async def _disconnect(self, log_callback):
+        client, self.client, self._auth = self.client, None, None
+        if client is not None:
+            try:
+                await client.disconnect()
+                log_callback("Отключение от Telegram.")
+            except Exception:
+                pass
+
+    def list_chats(self, api_id, api_hash, phone, log_callback, full=False):
+        """Future со списком чатов [(name, id)], как у list_chats."""
+        return self.submit(self._list_chats(api_id, api_hash, phone, log_callback, full))
+
+    async def _list_chats(self, api_id, api_hash, phone, log_callback, full):
+        cache = open_cache(log_callback=log_callback)
+        try:
+            client = await self._connected(api_id, api_hash, phone, log_callback)
+            log_callback("Получаю список чатов...")
+            chats = await _load_dialogs(client, cache, log_callback, full)
+            log_callback(f"Найдено {len(chats)} чатов.")
+            return chats
+        except Exception as e:
+            log_callback(f"Ошибка при получении списка чатов: {e}")
+            return []
+        finally:
+            if cache is not None:
+                cache.close()
+
+    def export(self, api_id, api_hash, phone, chat_id, start_date, end_date, log_callback, **options):
+        """Future с результатом экспорта за [start_date, end_date), как у export_messages_range."""
+        return self.submit(self._export(api_id, api_hash, phone, chat_id, start_date, end_date,
+                                        log_callback, **options))
+
+    async def _export(self, api_id, api_hash, phone, chat_id, start_date, end_date, log_callback, **options):
+        stats = ExportStats()
+        _current_stats.set(stats)
+        try:
+            with stats.phase("connect"):
+                client = await self._connected(api_id, api_hash, phone, log_callback)
+            return await _export_connected(client, chat_id, _as_utc(start_date), _as_utc(end_date),
+                                           log_callback, stats, **options)
+        except Exception as e:
+            log_callback(f"Исключение при экспорте: {e}")
+            return {"success": False, "message": f"Исключение: {e}"}
+
+    def close(self, timeout=10):
+        """Отключает клиент и останавливает поток."""
+        try:
+            self.submit(self._disconnect(lambda s: None)).result(timeout)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        if not self._thread.is_alive():
+            self.loop.close()
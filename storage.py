@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+"""
+Хранилище сообщений на SQLite для Telegram Chat Exporter
+"""
+
+import gzip
+import itertools
+import json
+import os
+import sqlite3
+import tempfile
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    chat_id   INTEGER NOT NULL,
+    msg_id    INTEGER NOT NULL,
+    date      INTEGER NOT NULL,
+    topic_id  INTEGER NOT NULL,
+    sender_id INTEGER,
+    author    TEXT NOT NULL,
+    text      TEXT NOT NULL,
+    media     TEXT,
+    PRIMARY KEY (chat_id, msg_id)
+);
+CREATE INDEX IF NOT EXISTS messages_topic ON messages (chat_id, topic_id, msg_id);
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id   INTEGER PRIMARY KEY,
+    title     TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS topics (
+    chat_id   INTEGER NOT NULL,
+    topic_id  INTEGER NOT NULL,
+    ord       INTEGER NOT NULL,
+    title     TEXT NOT NULL,
+    PRIMARY KEY (chat_id, topic_id)
+);
+CREATE TABLE IF NOT EXISTS topic_sync (
+    chat_id       INTEGER PRIMARY KEY,
+    last_activity INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dialogs (
+    chat_id   INTEGER PRIMARY KEY,
+    name      TEXT NOT NULL,
+    activity  INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dialog_sync (
+    id            INTEGER PRIMARY KEY CHECK (id = 0),
+    last_activity INTEGER NOT NULL,
+    total         INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    chat_id   INTEGER PRIMARY KEY,
+    cov_start INTEGER NOT NULL,
+    cov_end   INTEGER NOT NULL,
+    max_id    INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fetch_parts (
+    chat_id   INTEGER NOT NULL,
+    part      INTEGER NOT NULL,
+    start_ts  INTEGER NOT NULL,
+    end_ts    INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, part)
+);
+"""
+
+
+def _topic_filter(topic_ids):
+    """SQL-условие и параметры для отбора по списку топиков (None — все топики)."""
+    if topic_ids is None:
+        return "", ()
+    topic_ids = tuple(topic_ids)
+    return f" AND topic_id IN ({', '.join('?' * len(topic_ids))})", topic_ids
+
+
+class MessageStore:
+    """
+    Сообщения чатов на диске, ключ (chat_id, msg_id). Дата хранится как unix-время UTC.
+    Позволяет собрать сообщения без удержания их в памяти и затем прочитать их по топикам.
+
+    Постоянное хранилище дополнительно помнит для каждого чата непрерывно загруженный
+    интервал [cov_start, cov_end) и максимальный msg_id в нём (sync_state), а также
+    название чата и список топиков (topics, topic_sync) — этого хватает, чтобы повторный
+    экспорт покрытого периода вообще не обращался к Telegram.
+    """
+
+    def __init__(self, path, temporary=False, readonly=False):
+        self.path = path
+        self.temporary = temporary
+        if readonly:
+            # только чтение (например, из пула процессов): без прагм и схемы, не мешая писателю;
+            # urllib.request (с http.client) импортируется здесь, а не при запуске программы
+            from urllib.request import pathname2url
+            self.conn = sqlite3.connect(f"file:{pathname2url(os.path.abspath(path))}?mode=ro", uri=True)
+            return
+        self.conn = sqlite3.connect(path)
+        if temporary:
+            # временный файл не нужно защищать от сбоев — он удаляется при закрытии
+            self.conn.execute("PRAGMA journal_mode=OFF")
+            self.conn.execute("PRAGMA synchronous=OFF")
+        else:
+            # WAL + NORMAL: закоммиченное переживает падение программы, а коммиты дешёвые —
+            # их можно делать часто, как контрольные точки экспорта
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        # кэши, созданные до появления вложений
+        if "media" not in {row[1] for row in self.conn.execute("PRAGMA table_info(messages)")}:
+            self.conn.execute("ALTER TABLE messages ADD COLUMN media TEXT")
+
+    @classmethod
+    def temporary_store(cls, dir=None):
+        """Хранилище во временном файле, удаляемом при close()."""
+        fd, path = tempfile.mkstemp(prefix="tg_export_", suffix=".sqlite", dir=dir)
+        os.close(fd)
+        return cls(path, temporary=True)
+
+    @staticmethod
+    def remove(path):
+        """Удаляет файл хранилища вместе с журналами WAL; отсутствующие файлы пропускаются."""
+        for p in (path, path + "-wal", path + "-shm", path + "-journal"):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    def add_messages(self, chat_id, rows):
+        """rows: итерируемое (msg_id, date, topic_id, sender_id, author, text, media); media — путь к вложению или None."""
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO messages (chat_id, msg_id, date, topic_id, sender_id, author, text, media) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((chat_id,) + tuple(row) for row in rows),
+        )
+
+    def commit(self):
+        self.conn.commit()
+
+    def topic_counts(self, chat_id, start_ts, end_ts, topic_ids=None):
+        """{topic_id: (кол-во сообщений, первый msg_id)} за [start_ts, end_ts); topic_ids — только эти топики."""
+        where, params = _topic_filter(topic_ids)
+        cur = self.conn.execute(
+            "SELECT topic_id, COUNT(*), MIN(msg_id) FROM messages "
+            "WHERE chat_id = ? AND date >= ? AND date < ?" + where + " GROUP BY topic_id",
+            (chat_id, start_ts, end_ts) + params,
+        )
+        return {tid: (count, first_id) for tid, count, first_id in cur}
+
+    def count(self, chat_id, start_ts, end_ts, topic_ids=None):
+        where, params = _topic_filter(topic_ids)
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM messages WHERE chat_id = ? AND date >= ? AND date < ?" + where,
+            (chat_id, start_ts, end_ts) + params,
+        ).fetchone()[0]
+
+    def max_msg_id(self, chat_id, topic_id=None, start_ts=None, end_ts=None):
+        """
+        Наибольший сохранённый msg_id чата (с topic_id — только в этом топике,
+        со start_ts/end_ts — только за [start_ts, end_ts)); 0, если сообщений нет.
+        """
+        where, params = "chat_id = ?", [chat_id]
+        if topic_id is not None:
+            where += " AND topic_id = ?"
+            params.append(topic_id)
+        if start_ts is not None:
+            where += " AND date >= ? AND date < ?"
+            params += [start_ts, end_ts]
+        return self.conn.execute(f"SELECT MAX(msg_id) FROM messages WHERE {where}", params).fetchone()[0] or 0
+
+    # --- метаданные чата ---
+    def save_chat(self, chat_id, title):
+        self.conn.execute("INSERT OR REPLACE INTO chats (chat_id, title) VALUES (?, ?)", (chat_id, title))
+        self.conn.commit()
+
+    def load_chat(self, chat_id):
+        """Название чата или None, если чат ещё не сохранялся."""
+        row = self.conn.execute("SELECT title FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    def save_topics(self, chat_id, topics, last_activity):
+        """
+        Запоминает список топиков {topic_id: title} в его порядке и время последней
+        активности в форуме на момент обновления — от него идёт следующее инкрементальное обновление.
+        """
+        self.conn.execute("DELETE FROM topics WHERE chat_id = ?", (chat_id,))
+        self.conn.executemany(
+            "INSERT INTO topics (chat_id, topic_id, ord, title) VALUES (?, ?, ?, ?)",
+            ((chat_id, tid, n, tname) for n, (tid, tname) in enumerate(topics.items())),
+        )
+        self.conn.execute(
+            "INSERT OR REPLACE INTO topic_sync (chat_id, last_activity) VALUES (?, ?)", (chat_id, last_activity)
+        )
+        self.conn.commit()
+
+    def load_topics(self, chat_id):
+        """({topic_id: title}, last_activity) или (None, None), если топики ещё не сохранялись."""
+        row = self.conn.execute("SELECT last_activity FROM topic_sync WHERE chat_id = ?", (chat_id,)).fetchone()
+        if row is None:
+            return None, None
+        cur = self.conn.execute("SELECT topic_id, title FROM topics WHERE chat_id = ? ORDER BY ord", (chat_id,))
+        return dict(cur.fetchall()), row[0]
+
+    # --- список чатов ---
+    def save_dialogs(self, dialogs, last_activity, total, replace=False):
+        """
+        Обновляет список чатов: dialogs — [(chat_id, name, activity)], activity — время
+        последнего сообщения (unix). replace — список получен целиком: чаты, которых в нём нет, удаляются.
+        last_activity и total (число всех диалогов аккаунта) — точка отсчёта следующего обновления.
+        """
+        if replace:
+            self.conn.execute("DELETE FROM dialogs")
+        self.conn.executemany("INSERT OR REPLACE INTO dialogs (chat_id, name, activity) VALUES (?, ?, ?)", dialogs)
+        self.conn.execute("INSERT OR REPLACE INTO dialog_sync (id, last_activity, total) VALUES (0, ?, ?)",
+                          (last_activity, total))
+        self.conn.commit()
+
+    def load_dialogs(self):
+        """
+        ([(name, chat_id)] по убыванию активности, last_activity, total)
+        или (None, None, None), если список ещё не сохранялся.
+        """
+        row = self.conn.execute("SELECT last_activity, total FROM dialog_sync WHERE id = 0").fetchone()
+        if row is None:
+            return None, None, None
+        cur = self.conn.execute("SELECT name, chat_id FROM dialogs ORDER BY activity DESC, name")
+        return cur.fetchall(), row[0], row[1]
+
+    # --- состояние синхронизации ---
+    def get_sync(self, chat_id):
+        """(cov_start, cov_end, max_id) или None."""
+        return self.conn.execute(
+            "SELECT cov_start, cov_end, max_id FROM sync_state WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+
+    def set_sync(self, chat_id, cov_start, cov_end, max_id):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO sync_state (chat_id, cov_start, cov_end, max_id) VALUES (?, ?, ?, ?)",
+            (chat_id, cov_start, cov_end, max_id),
+        )
+        self.conn.commit()
+
+    def covers(self, chat_id, start_ts, end_ts):
+        """Весь [start_ts, end_ts) уже загружен и метаданные чата сохранены."""
+        state = self.get_sync(chat_id)
+        return (state is not None and state[0] <= start_ts and state[1] >= end_ts
+                and self.load_chat(chat_id) is not None and self.load_topics(chat_id)[0] is not None)
+
+    # --- части параллельной загрузки (в файле контрольной точки) ---
+    def save_parts(self, chat_id, parts):
+        """Запоминает, на какие части [(start_ts, end_ts)] разбит период загрузки чата."""
+        self.conn.execute("DELETE FROM fetch_parts WHERE chat_id = ?", (chat_id,))
+        self.conn.executemany("INSERT INTO fetch_parts (chat_id, part, start_ts, end_ts) VALUES (?, ?, ?, ?)",
+                              ((chat_id, k, start_ts, end_ts) for k, (start_ts, end_ts) in enumerate(parts)))
+        self.conn.commit()
+
+    def load_parts(self, chat_id):
+        """Части [(start_ts, end_ts)], сохранённые save_parts; пустой список, если период читался целиком."""
+        return self.conn.execute(
+            "SELECT start_ts, end_ts FROM fetch_parts WHERE chat_id = ? ORDER BY part", (chat_id,)
+        ).fetchall()
+
+    def has_media(self, chat_id, start_ts, end_ts, topic_ids=None):
+        """Есть ли за [start_ts, end_ts) сообщения со скачанными вложениями."""
+        where, params = _topic_filter(topic_ids)
+        return self.conn.execute(
+            "SELECT 1 FROM messages WHERE chat_id = ? AND date >= ? AND date < ? AND media IS NOT NULL"
+            + where + " LIMIT 1",
+            (chat_id, start_ts, end_ts) + params,
+        ).fetchone() is not None
+
+    def clear_media(self, chat_id, paths):
+        """Убирает ссылки на вложения, которые не удалось скачать."""
+        self.conn.executemany("UPDATE messages SET media = NULL WHERE chat_id = ? AND media = ?",
+                              ((chat_id, path) for path in paths))
+        self.conn.commit()
+
+    def iter_topic(self, chat_id, topic_id, start_ts, end_ts):
+        """Потоково отдаёт (author, date, text, media) сообщений топика по возрастанию msg_id."""
+        return self.conn.execute(
+            "SELECT author, date, text, media FROM messages "
+            "WHERE chat_id = ? AND topic_id = ? AND date >= ? AND date < ? ORDER BY msg_id",
+            (chat_id, topic_id, start_ts, end_ts),
+        )
+
+    def iter_messages(self, chat_id, start_ts, end_ts, topic_ids=None):
+        """
+        Все сообщения [start_ts, end_ts) по возрастанию msg_id:
+        (msg_id, date, topic_id, sender_id, author, text, media).
+        """
+        where, params = _topic_filter(topic_ids)
+        return self.conn.execute(
+            "SELECT msg_id, date, topic_id, sender_id, author, text, media FROM messages "
+            "WHERE chat_id = ? AND date >= ? AND date < ?" + where + " ORDER BY msg_id",
+            (chat_id, start_ts, end_ts) + params,
+        )
+
+    def close(self):
+        try:
+            self.conn.close()
+        finally:
+            if self.temporary:
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+
+
+# --- Полнотекстовый поиск ---
+_SEARCH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    id        INTEGER PRIMARY KEY,
+    chat_id   INTEGER NOT NULL,
+    msg_id    INTEGER NOT NULL,
+    date      INTEGER NOT NULL,
+    topic_id  INTEGER NOT NULL,
+    topic     TEXT NOT NULL,
+    author    TEXT NOT NULL,
+    text      TEXT NOT NULL,
+    UNIQUE (chat_id, msg_id)
+);
+CREATE INDEX IF NOT EXISTS docs_date ON docs (date);
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id   INTEGER PRIMARY KEY,
+    title     TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(
+    text, author, topic, content='docs', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS docs_ai AFTER INSERT ON docs BEGIN
+    INSERT INTO docs_fts (rowid, text, author, topic) VALUES (new.id, new.text, new.author, new.topic);
+END;
+CREATE TRIGGER IF NOT EXISTS docs_ad AFTER DELETE ON docs BEGIN
+    INSERT INTO docs_fts (docs_fts, rowid, text, author, topic) VALUES ('delete', old.id, old.text, old.author, old.topic);
+END;
+"""
+
+
+def fts_query(query):
+    """
+    Запрос пользователя → выражение FTS5: каждое слово ищется как есть (все слова обязательны),
+    «слово*» — по префиксу. Кавычки и операторы FTS5 в словах экранируются, поэтому
+    произвольный текст не даёт синтаксической ошибки.
+    """
+    terms = []
+    for word in query.split():
+        prefix = word.endswith("*") and len(word) > 1
+        word = word.rstrip("*") if prefix else word
+        terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+class SearchIndex:
+    """
+    Полнотекстовый индекс (SQLite FTS5) по всем выгруженным сообщениям: текст, автор и топик.
+    Обновляется после каждого экспорта: новые сообщения добавляются, изменённые
+    (правка текста, новое имя автора или топика) переиндексируются, остальные не трогаются.
+    Если SQLite собран без FTS5, конструктор бросает sqlite3.OperationalError.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SEARCH_SCHEMA)
+
+    def add(self, chat_id, chat_title, rows):
+        """
+        rows: итерируемое (msg_id, date, topic_id, topic, author, text).
+        Возвращает число добавленных или переиндексированных сообщений.
+        """
+        changed = 0
+        self.conn.execute("INSERT OR REPLACE INTO chats (chat_id, title) VALUES (?, ?)", (chat_id, chat_title))
+        rows = iter(rows)
+        while True:
+            batch = [(chat_id,) + tuple(row) for row in itertools.islice(rows, 10000)]
+            if not batch:
+                break
+            # изменившиеся строки удаляются (триггер убирает их из FTS) и вставляются заново,
+            # совпадающие остаются как есть — INSERT OR IGNORE их пропускает
+            self.conn.executemany(
+                "DELETE FROM docs WHERE chat_id = ?1 AND msg_id = ?2 "
+                "AND (date != ?3 OR topic_id != ?4 OR topic != ?5 OR author != ?6 OR text != ?7)",
+                batch,
+            )
+            changed += self.conn.executemany(
+                "INSERT OR IGNORE INTO docs (chat_id, msg_id, date, topic_id, topic, author, text) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                batch,
+            ).rowcount
+        self.conn.commit()
+        return changed
+
+    def search(self, query, chat_ids=None, start_ts=None, end_ts=None, limit=50, by_date=False):
+        """
+        Сообщения, подходящие под query (см. fts_query), лучшие совпадения первыми
+        (by_date — сначала новые): (chat_id, chat_title, msg_id, date, topic, author, snippet).
+        chat_ids, start_ts/end_ts — ограничить чатами и периодом [start_ts, end_ts).
+        """
+        where, params = "docs_fts MATCH ?", [fts_query(query)]
+        if chat_ids:
+            where += f" AND d.chat_id IN ({', '.join('?' * len(chat_ids))})"
+            params += list(chat_ids)
+        if start_ts is not None:
+            where += " AND d.date >= ?"
+            params.append(start_ts)
+        if end_ts is not None:
+            where += " AND d.date < ?"
+            params.append(end_ts)
+        return self.conn.execute(
+            "SELECT d.chat_id, COALESCE(c.title, d.chat_id), d.msg_id, d.date, d.topic, d.author, "
+            "snippet(docs_fts, 0, '[', ']', '…', 16) "
+            "FROM docs_fts JOIN docs d ON d.id = docs_fts.rowid LEFT JOIN chats c ON c.chat_id = d.chat_id "
+            f"WHERE {where} ORDER BY {'d.date DESC' if by_date else 'rank'} LIMIT ?",
+            params + [limit],
+        ).fetchall()
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+# --- Сырой дамп ---
+RAW_FORMAT = "tg-chat-exp-raw"
+RAW_VERSION = 1
+_RAW_FIELDS = ("id", "date", "topic", "sender_id", "author", "text", "media")
+
+
+def write_raw_dump(path, header, rows):
+    """
+    Сырой дамп экспорта: gzip JSONL. Первая строка — заголовок (чат, период, топики),
+    далее по строке на сообщение {id, date, topic, sender_id, author, text, media}.
+    Пишется во временный файл и переименовывается, чтобы не оставлять обрезанных дампов.
+    """
+    tmp = path + ".tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        f.write(json.dumps(dict(header, format=RAW_FORMAT, version=RAW_VERSION), ensure_ascii=False) + "\n")
+        for row in rows:
+            f.write(json.dumps(dict(zip(_RAW_FIELDS, row)), ensure_ascii=False) + "\n")
+    os.replace(tmp, path)
+
+
+def read_raw_dump(path):
+    """Возвращает (header, итератор строк (msg_id, date, topic_id, sender_id, author, text, media))."""
+    f = gzip.open(path, "rt", encoding="utf-8")
+    header = json.loads(f.readline() or "{}")
+    if header.get("format") != RAW_FORMAT:
+        f.close()
+        raise ValueError(f"{path}: не является сырым дампом {RAW_FORMAT}")
+
+    def rows():
+        with f:
+            for line in f:
+                if line.strip():
+                    rec = json.loads(line)
+                    yield tuple(rec.get(k) for k in _RAW_FIELDS)
+
+    return header, rows()
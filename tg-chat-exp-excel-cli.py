@@ -5,23 +5,46 @@
 Версия CLI - работает в консоли.
 """
 
-import os
-from datetime import datetime
-import dotenv
+import argparse
+import json
+import multiprocessing
+import re
+import sys
+from datetime import datetime, timedelta, timezone
 
-dotenv.load_dotenv()
+from core import (PROGRAM_NAME, PROGRAM_VERSION, SESSION_NAME, list_chats, cached_chats, resolve_chat_refs,
+                  export_messages, export_batch, check_env_vars, get_settings, month_range, render_dumps, parse_tz,
+                  search_messages)
+from writers import WRITERS, XLSX_LAYOUTS
 
-from core import PROGRAM_NAME, PROGRAM_VERSION, SESSION_NAME, list_chats, export_messages, check_env_vars
+# параметры из .env читаются только командами, которым нужно подключение (get_settings — один раз за запуск)
+YEAR_DEFAULT = 2025
+MONTH_DEFAULT = 9
 
-API_ID = os.getenv("API_ID")
-API_HASH = os.getenv("API_HASH")
-PHONE = os.getenv("PHONE")
-YEAR_DEFAULT = int(os.getenv("YEAR_DEFAULT", "2025"))
-MONTH_DEFAULT = int(os.getenv("MONTH_DEFAULT", "9"))
+# коды завершения для планировщиков
+EXIT_OK = 0        # все задания выполнены (или за период нет сообщений)
+EXIT_FAILED = 1    # часть заданий завершилась с ошибкой
+EXIT_USAGE = 2     # неверные параметры, нет .env, чат не найден
 
-def cli_log(s: str):
+
+def cli_log(s: str, file=None):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"{ts} — {s}")
+    print(f"{ts} — {s}", file=file or sys.stdout)
+
+
+def err_log(s: str):
+    """Лог в stderr — в режиме --json stdout занят результатом."""
+    cli_log(s, sys.stderr)
+
+
+def print_json(data):
+    print(json.dumps(data, ensure_ascii=False, indent=1, default=str))
+
+
+def auth():
+    """(API_ID, API_HASH, SESSION_NAME, PHONE) — первые аргументы list_chats / export_*."""
+    settings = get_settings()
+    return settings["API_ID"], settings["API_HASH"], SESSION_NAME, settings["PHONE"]
 
 def run_cli():
     print(f"=== {PROGRAM_NAME} {PROGRAM_VERSION} — CLI ===")
@@ -29,7 +52,7 @@ def run_cli():
 
     # выбор чата
     cli_log("Загружаю список чатов для выбора...")
-    chats = list_chats(API_ID, API_HASH, SESSION_NAME, PHONE, log_callback=cli_log)
+    chats = list_chats(*auth(), log_callback=cli_log)
     if not chats:
         cli_log("Не удалось получить список чатов. Завершение.")
         return
@@ -39,21 +62,234 @@ def run_cli():
     idx = int(sel) - 1 if sel.isdigit() and 1 <= int(sel) <= len(chats) else 0
     chat_id = chats[idx][1]
 
-    year_in = input(f"Введите год [YYYY] (Enter = {YEAR_DEFAULT}): ").strip()
-    month_in = input(f"Введите месяц [1-12] (Enter = {MONTH_DEFAULT}): ").strip()
-    year = int(year_in) if year_in.isdigit() else YEAR_DEFAULT
-    month = int(month_in) if month_in.isdigit() else MONTH_DEFAULT
+    settings = get_settings()
+    year_default = int(settings["YEAR_DEFAULT"] or YEAR_DEFAULT)
+    month_default = int(settings["MONTH_DEFAULT"] or MONTH_DEFAULT)
+    year_in = input(f"Введите год [YYYY] (Enter = {year_default}): ").strip()
+    month_in = input(f"Введите месяц [1-12] (Enter = {month_default}): ").strip()
+    year = int(year_in) if year_in.isdigit() else year_default
+    month = int(month_in) if month_in.isdigit() else month_default
 
     cli_log(f"Запуск экспорта для чата {chat_id} за {year}-{month:02d}")
-    res = export_messages(API_ID, API_HASH, SESSION_NAME, PHONE, chat_id, year, month, log_callback=cli_log)
+    res = export_messages(*auth(), chat_id, year, month, log_callback=cli_log)
     if res.get("success"):
         cli_log(f"Успех. Сохранён файл: {res['filename']} (сообщений: {res['count']})")
     else:
         cli_log(f"Завершено с сообщением: {res.get('message')}")
 
+def parse_period_bound(s, is_end=False):
+    """
+    Граница периода из YYYY-MM или YYYY-MM-DD (UTC). Конец включительный:
+    --to 2025-03 означает «до конца марта», --to 2025-03-15 — «до конца 15 марта».
+    Для запуска по расписанию понимает и относительные значения (UTC): this-month,
+    last-month, today, yesterday.
+    """
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if s in ("this-month", "last-month"):
+        month = today.replace(day=1)
+        if s == "last-month":
+            month = (month - timedelta(days=1)).replace(day=1)
+        return month_range(month.year, month.month)[1] if is_end else month
+    if s in ("today", "yesterday"):
+        day = today - timedelta(days=1) if s == "yesterday" else today
+        return day + timedelta(days=1) if is_end else day
+    try:
+        if len(s) == 7:
+            d = datetime.strptime(s, "%Y-%m").replace(tzinfo=timezone.utc)
+            return month_range(d.year, d.month)[1] if is_end else d
+        d = datetime.strptime(s, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        return d + timedelta(days=1) if is_end else d
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"ожидается YYYY-MM или YYYY-MM-DD: {s}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description=f"{PROGRAM_NAME} {PROGRAM_VERSION} — CLI. Без команды запускается интерактивный режим."
+    )
+    sub = parser.add_subparsers(dest="command")
+
+    p_export = sub.add_parser("export", help="пакетный экспорт нескольких чатов за период по одному подключению",
+                              epilog=f"Коды завершения: {EXIT_OK} — успех, {EXIT_FAILED} — часть заданий с ошибкой, "
+                                     f"{EXIT_USAGE} — неверные параметры или чат не найден.")
+    p_export.add_argument("--chats", nargs="+", required=True, metavar="CHAT",
+                          help="ID или точные названия чатов; если указаны только ID, список диалогов не загружается")
+    p_export.add_argument("--from", dest="date_from", required=True,
+                          help="начало периода: YYYY-MM, YYYY-MM-DD, this-month, last-month, today или yesterday")
+    p_export.add_argument("--to", dest="date_to", help="конец периода включительно (по умолчанию = --from)")
+    p_export.add_argument("--per", choices=("month", "chat"), default="month",
+                          help="файл на каждый месяц (month) или один файл на чат за весь период (chat)")
+    p_export.add_argument("--out", help="папка для файлов")
+    p_export.add_argument("--state", help="JSON-файл состояния пакета для возобновления")
+    p_export.add_argument("--cache", action="store_true",
+                          help="хранить сообщения в локальном кэше и загружать из Telegram только новые")
+    p_export.add_argument("--topics", nargs="+", type=int, metavar="TOPIC_ID",
+                          help="только эти топики форума: загружаются лишь их ветки, а не вся история")
+    p_export.add_argument("--resume", action="store_true",
+                          help="продолжить прерванные задания с контрольных точек tg_partial_*.sqlite")
+    p_export.add_argument("--media", action="store_true",
+                          help="скачать вложения (фото, документы, голосовые) в папку media рядом с файлами")
+    p_export.add_argument("--raw", action="store_true",
+                          help="сохранить рядом с xlsx сырой дамп .jsonl.gz для команды render")
+    p_export.add_argument("--stats", action="store_true",
+                          help="записать замеры по фазам экспорта в <файл>.stats.json рядом с xlsx")
+    p_export.add_argument("--format", dest="formats", nargs="+", choices=list(WRITERS), default=["xlsx"],
+                          metavar="FMT", help="форматы файлов: xlsx, csv, parquet (можно несколько за одну загрузку)")
+    p_export.add_argument("--layout", choices=XLSX_LAYOUTS, default="sheets",
+                          help="раскладка xlsx: sheets — лист на каждый топик, table — один лист с колонкой "
+                               "топика и автофильтром (файл примерно вдвое меньше)")
+    p_export.add_argument("--concurrency", type=int, default=1, metavar="N",
+                          help="сколько чатов/месяцев выгружать одновременно (по умолчанию 1)")
+    p_export.add_argument("--shards", type=int, default=1, metavar="N",
+                          help="читать период каждого задания N частями параллельно (для очень больших чатов)")
+    p_export.add_argument("--no-index", dest="search_index", action="store_false",
+                          help="не добавлять выгруженные сообщения в поисковый индекс")
+    p_export.add_argument("--json", action="store_true",
+                          help="результат пакета в JSON на stdout (лог — в stderr)")
+
+    p_chats = sub.add_parser("chats", help="список чатов с ID (для --chats)")
+    p_chats.add_argument("--cached", action="store_true", help="только из локального кэша, без подключения")
+    p_chats.add_argument("--full", action="store_true", help="перечитать все диалоги, а не только новые")
+    p_chats.add_argument("--json", action="store_true", help="список в JSON")
+
+    p_render = sub.add_parser("render", help="перестроить файлы из сырых дампов без подключения к Telegram")
+    p_render.add_argument("dumps", nargs="+", metavar="DUMP", help="файлы .jsonl.gz, сохранённые с --raw")
+    p_render.add_argument("--out", help="папка для файлов (по умолчанию — рядом с дампом)")
+    p_render.add_argument("--tz", default="local",
+                          help="часовой пояс дат: local, UTC, +03:00 или имя вроде Europe/Moscow")
+    p_render.add_argument("--format", dest="formats", nargs="+", choices=list(WRITERS), default=["xlsx"],
+                          metavar="FMT", help="форматы файлов: xlsx, csv, parquet")
+    p_render.add_argument("--layout", choices=XLSX_LAYOUTS, default="sheets", help="раскладка xlsx (как в export)")
+    p_render.add_argument("--workers", type=int, default=1, metavar="N", help="число параллельных процессов")
+
+    p_search = sub.add_parser("search", help="поиск по всем выгруженным сообщениям без подключения к Telegram")
+    p_search.add_argument("query", nargs="+", help="слова для поиска (все обязательны; слово* — по началу слова)")
+    p_search.add_argument("--chats", nargs="+", type=int, metavar="ID", help="только в этих чатах")
+    p_search.add_argument("--from", dest="date_from", help="начало периода: YYYY-MM или YYYY-MM-DD")
+    p_search.add_argument("--to", dest="date_to", help="конец периода включительно")
+    p_search.add_argument("--limit", type=int, default=50, metavar="N", help="не больше N результатов (50)")
+    p_search.add_argument("--by-date", action="store_true", help="сначала новые, а не лучшие совпадения")
+    p_search.add_argument("--json", action="store_true", help="результаты в JSON")
+    return parser
+
+
+def resolve_chats(refs, log):
+    """
+    ID чатов из --chats. Названия ищутся сначала в локальном кэше списка чатов
+    и только если там их нет — в Telegram (инкрементальное обновление списка).
+    """
+    ids, errors = resolve_chat_refs(refs, cached_chats())
+    if errors:
+        log("Не все названия чатов есть в кэше, обновляю список чатов...")
+        ids, errors = resolve_chat_refs(refs, list_chats(*auth(), log_callback=log))
+    return ids, errors
+
+
+def run_batch(args):
+    log = err_log if args.json else cli_log
+    try:
+        start = parse_period_bound(args.date_from)
+        end = parse_period_bound(args.date_to or args.date_from, is_end=True)
+    except argparse.ArgumentTypeError as e:
+        return fail(args, str(e))
+    if start >= end:
+        return fail(args, "Начало периода должно быть раньше конца.")
+    if all(re.fullmatch(r"-?\d+", ref) for ref in args.chats):
+        chat_ids = [int(ref) for ref in args.chats]
+    else:
+        chat_ids, errors = resolve_chats(args.chats, log)
+        if errors:
+            return fail(args, "; ".join(errors))
+    log(f"Пакетный экспорт: чатов {len(chat_ids)}, период {start:%Y-%m-%d} — {end - timedelta(days=1):%Y-%m-%d}")
+    res = export_batch(*auth(), chat_ids, start, end,
+                       per=args.per, output_dir=args.out, state_file=args.state,
+                       concurrency=args.concurrency, use_cache=args.cache, raw=args.raw, topic_ids=args.topics,
+                       stats_json=args.stats, formats=args.formats, resume=args.resume, media=args.media,
+                       search_index=args.search_index, shards=max(1, args.shards), layout=args.layout,
+                       log_callback=log)
+    if args.json:
+        print_json(res)
+    else:
+        for job in res.get("jobs", []):
+            status = "OK" if job.get("success") else ("пусто" if job.get("empty") else "ОШИБКА")
+            detail = ", ".join(job.get("files") or []) or job.get("filename") or job.get("message", "")
+            print(f"{status:6} {job['chat_id']} {job['start'][:10]}…{job['end'][:10]}  {detail}")
+        if res.get("message"):
+            cli_log(res["message"])
+    return EXIT_OK if res.get("success") else EXIT_FAILED
+
+
+def run_chats(args):
+    log = err_log if args.json else cli_log
+    if args.cached:
+        chats = cached_chats()
+    else:
+        chats = list_chats(*auth(), log_callback=log, full=args.full)
+    if args.json:
+        print_json([{"id": cid, "name": name} for name, cid in chats])
+    else:
+        for name, cid in chats:
+            print(f"{cid:>16}  {name}")
+    return EXIT_OK if chats else EXIT_FAILED
+
+
+def fail(args, message):
+    """Ошибка параметров: в лог (и в stdout в JSON с --json), код EXIT_USAGE."""
+    if getattr(args, "json", False):
+        err_log(message)
+        print_json({"success": False, "message": message})
+    else:
+        cli_log(message)
+    return EXIT_USAGE
+
+
+def run_render(args):
+    try:
+        tz = parse_tz(args.tz)
+    except ValueError as e:
+        return fail(args, str(e))
+    results = render_dumps(args.dumps, output_dir=args.out, tz=tz, workers=args.workers,
+                           formats=args.formats, layout=args.layout, log_callback=cli_log)
+    return EXIT_OK if all(r.get("success") for r in results) else EXIT_FAILED
+
+
+def run_search(args):
+    try:
+        start = parse_period_bound(args.date_from) if args.date_from else None
+        end = parse_period_bound(args.date_to, is_end=True) if args.date_to else None
+    except argparse.ArgumentTypeError as e:
+        return fail(args, str(e))
+    res = search_messages(" ".join(args.query), chat_ids=args.chats, start_date=start, end_date=end,
+                          limit=args.limit, by_date=args.by_date)
+    if not res.get("success"):
+        cli_log(res.get("message"), sys.stderr if args.json else None)
+        return EXIT_FAILED
+    if args.json:
+        print_json(res["results"])
+        return EXIT_OK
+    for r in res["results"]:
+        date = datetime.fromisoformat(r["date"]).astimezone().strftime("%Y-%m-%d %H:%M")
+        print(f"{date}  {r['chat']} / {r['topic']}  {r['author']}: {r['snippet']}")
+    cli_log(f"Найдено: {len(res['results'])}")
+    return EXIT_OK
+
+
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # пул процессов для записи xlsx в сборке pyinstaller
+    args = build_parser().parse_args()
+    # перестроение из дампов и поиск не требуют ни .env, ни подключения к Telegram
+    if args.command == "render":
+        sys.exit(run_render(args))
+    if args.command == "search":
+        sys.exit(run_search(args))
     ok, missing = check_env_vars()
     if not ok:
-        print("❌ Ошибка: отсутствуют параметры в .env:", ", ".join(missing))
-    else:
-        run_cli()
+        if args.command is None:
+            print("❌ Ошибка: отсутствуют параметры в .env:", ", ".join(missing))
+            sys.exit(EXIT_USAGE)
+        sys.exit(fail(args, "Отсутствуют параметры в .env: " + ", ".join(missing)))
+    if args.command == "export":
+        sys.exit(run_batch(args))
+    if args.command == "chats":
+        sys.exit(run_chats(args))
+    run_cli()
@@ -6,13 +6,14 @@
 """
 
 import os
-import threading
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
-import asyncio
 from datetime import datetime
 import core
 
+LOG_MAX_LINES = 5000   # в окне лога остаются только последние строки
+POLL_MS = 100          # как часто окно забирает накопленные строки лога и прогресс
+
 
 class ChatExporterGUI:
     def __init__(self, root):
@@ -27,21 +28,37 @@ class ChatExporterGUI:
         self.year_var = tk.StringVar()
         self.month_var = tk.StringVar()
         self.chat_var = tk.StringVar()
+        self.use_cache_var = tk.BooleanVar(value=False)
+        self.resume_var = tk.BooleanVar(value=False)
+        self.media_var = tk.BooleanVar(value=False)
+        self.table_var = tk.BooleanVar(value=False)
         self.log_text = None
         self.progress = None
         self.open_btn = None
 
         # --- загрузка env ---
-        env = core.load_env_vars()
+        env = core.get_settings()
         self.api_id_var.set(env.get("API_ID", ""))
         self.api_hash_var.set(env.get("API_HASH", ""))
         self.phone_var.set(env.get("PHONE", ""))
         self.year_var.set(env.get("YEAR_DEFAULT", ""))
         self.month_var.set(env.get("MONTH_DEFAULT", ""))
 
+        # --- один подключённый клиент Telegram на всю сессию GUI ---
+        self.worker = core.ClientWorker(core.SESSION_NAME)
+        # лог и прогресс из потока клиента приходят через очередь, виджеты трогает только главный поток
+        self.channel = core.ProgressChannel()
+
         # --- интерфейс ---
         self._build_ui()
 
+        # --- список чатов из локального кэша, без подключения ---
+        chats = core.cached_chats()
+        if chats:
+            self._update_chat_list([f"{name} ({cid})" for name, cid in chats])
+            self.log(f"Список чатов из кэша: {len(chats)}. «Загрузить чаты» обновит его из Telegram.")
+        self._poll()
+
     def _build_ui(self):
         # --- Параметры авторизации ---
         frm_auth = ttk.LabelFrame(self.root, text="Авторизация")
@@ -80,9 +97,18 @@ class ChatExporterGUI:
         ttk.Entry(frm_export, textvariable=self.month_var).grid(row=4, column=1, sticky="ew")
 
 
+        ttk.Checkbutton(frm_export, text="Локальный кэш сообщений (загружать только новые)",
+                        variable=self.use_cache_var).grid(row=5, column=0, columnspan=2, sticky="w")
+        ttk.Checkbutton(frm_export, text="Продолжить прерванный экспорт с контрольной точки",
+                        variable=self.resume_var).grid(row=6, column=0, columnspan=2, sticky="w")
+        ttk.Checkbutton(frm_export, text="Скачать вложения (фото, документы) в папку media",
+                        variable=self.media_var).grid(row=7, column=0, columnspan=2, sticky="w")
+        ttk.Checkbutton(frm_export, text="Все сообщения на одном листе с фильтром по топику (файл меньше)",
+                        variable=self.table_var).grid(row=8, column=0, columnspan=2, sticky="w")
+
         # Кнопка экспорта
         self.export_btn = ttk.Button(frm_export, text="Экспортировать", command=self.export_messages, state="disabled")
-        self.export_btn.grid(row=7, column=0, columnspan=2, pady=5)
+        self.export_btn.grid(row=9, column=0, columnspan=2, pady=5)
 
 
         # --- Лог ---
@@ -98,15 +124,29 @@ class ChatExporterGUI:
         self.open_btn.grid(row=10, column=0, columnspan=2, pady=5)
 
         # Прогресс
-        self.progress = ttk.Progressbar(frm_log, mode="indeterminate")
+        self.progress = ttk.Progressbar(frm_log, mode="determinate", maximum=100)
         self.progress.grid(row=8, column=0, columnspan=2, pady=5, sticky="nsew")
         self.progress.grid_remove()  # скрываем до начала экспорта
 
     def log(self, text):
-        ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.log_text.insert(tk.END, ts + " — " + text + "\n")
-        self.log_text.see(tk.END)
-        self.root.update_idletasks()
+        """Можно вызывать из любого потока: строка появится в окне при следующем _poll."""
+        self.channel.log(text)
+
+    def _poll(self):
+        lines, fraction, calls = self.channel.drain()
+        if lines:
+            self.log_text.insert(tk.END, "".join(
+                datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S") + " — " + text + "\n" for ts, text in lines
+            ))
+            excess = int(self.log_text.index("end-1c").split(".")[0]) - 1 - LOG_MAX_LINES
+            if excess > 0:
+                self.log_text.delete("1.0", f"{excess + 1}.0")
+            self.log_text.see(tk.END)
+        if fraction is not None:
+            self.progress["value"] = fraction * 100
+        for fn, args in calls:
+            fn(*args)
+        self.root.after(POLL_MS, self._poll)
 
     def save_env(self):
         """Сохраняем введённые параметры в .env"""
@@ -121,24 +161,27 @@ class ChatExporterGUI:
     def load_chats(self):
         self.save_env()
         self.load_btn.config(state="disabled")
-        threading.Thread(target=self._load_chats_thread).start()
-
-    def _load_chats_thread(self):
-        asyncio.set_event_loop(asyncio.new_event_loop())  # ✅ фиксим отсутствие event loop
-        chats = core.list_chats(
+        future = self.worker.list_chats(
             self.api_id_var.get(),
             self.api_hash_var.get(),
-            core.SESSION_NAME,
             self.phone_var.get(),
             log_callback=self.log
         )
-        chat_names = [f"{name} ({cid})" for name, cid in chats]
-        self.root.after(0, lambda: self._update_chat_list(chat_names))
+        future.add_done_callback(self._load_chats_done)
+
+    def _load_chats_done(self, future):
+        chats = future.result()
+        self.channel.call(self._update_chat_list, [f"{name} ({cid})" for name, cid in chats])
 
     def _update_chat_list(self, chat_names):
-        self.chat_combo["values"] = chat_names
         if chat_names:
-            self.chat_combo.current(0)
+            # выбранный чат остаётся выбранным после обновления списка
+            selected = self.chat_var.get()
+            self.chat_combo["values"] = chat_names
+            if selected in chat_names:
+                self.chat_combo.current(chat_names.index(selected))
+            else:
+                self.chat_combo.current(0)
             self.export_btn.config(state="normal")
         self.load_btn.config(state="normal")
 
@@ -156,33 +199,31 @@ class ChatExporterGUI:
             return
 
         try:
-            year = int(self.year_var.get())
-            month = int(self.month_var.get())
+            start_date, end_date = core.month_range(int(self.year_var.get()), int(self.month_var.get()))
         except ValueError:
             messagebox.showerror("Ошибка", "Введите корректный год и месяц")
             return
 
         self.export_btn.config(state="disabled")
+        self.progress["value"] = 0
         self.progress.grid()
-        self.progress.start()
-        threading.Thread(target=self._export_thread, args=(chat_id, year, month)).start()
-
-    def _export_thread(self, chat_id, year, month):
-        asyncio.set_event_loop(asyncio.new_event_loop())  # ✅ фиксим отсутствие event loop
-        result = core.export_messages(
+        future = self.worker.export(
             self.api_id_var.get(),
             self.api_hash_var.get(),
-            core.SESSION_NAME,
             self.phone_var.get(),
             chat_id,
-            year,
-            month,
-            log_callback=self.log
+            start_date,
+            end_date,
+            log_callback=self.log,
+            use_cache=self.use_cache_var.get(),
+            resume=self.resume_var.get(),
+            media=self.media_var.get(),
+            layout="table" if self.table_var.get() else "sheets",
+            progress_callback=self.channel.progress
         )
-        self.root.after(0, lambda: self._export_done(result))
+        future.add_done_callback(lambda f: self.channel.call(self._export_done, f.result()))
 
     def _export_done(self, result):
-        self.progress.stop()
         self.progress.grid_remove()
         self.export_btn.config(state="normal")
         if result.get("success"):
@@ -192,6 +233,10 @@ class ChatExporterGUI:
         else:
             messagebox.showerror("Ошибка экспорта", result.get("message", "Неизвестная ошибка"))
 
+    def on_close(self):
+        self.worker.close()
+        self.root.destroy()
+
     def open_folder(self):
         if hasattr(self, "last_file"):
             folder = os.path.dirname(self.last_file)
@@ -227,6 +272,7 @@ def run_gui():
     root = tk.Tk()
     root.bind("<Control-Key>", CopyPaste)
     app = ChatExporterGUI(root)
+    root.protocol("WM_DELETE_WINDOW", app.on_close)
     center_window(root)
 
     ok, missing = core.check_env_vars()
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+Форматы выходных файлов для Telegram Chat Exporter.
+
+Каждый writer — функция write(filename, store, chat_id, start_date, end_date, topics, tz=None, topic_ids=None):
+читает сообщения из MessageStore потоково и возвращает время фаз {имя: секунды}.
+Форматы регистрируются в WRITERS по расширению файла; write_file добавляет к ним раскладку xlsx (XLSX_LAYOUTS).
+"""
+
+import csv
+import datetime
+import os
+import time
+from collections import Counter
+from storage import MessageStore
+
+DATE_FORMAT = "%Y-%m-%d %H:%M"
+# предел строк на листе Excel; длинные листы продолжаются на «Лист (2)», «Лист (3)»…
+XLSX_MAX_ROWS = 1048576
+PARQUET_ROW_GROUP = 65536
+# раскладка xlsx: "sheets" — «Все сообщения» и отдельный лист на каждый топик (каждый текст записан дважды),
+# "table" — один лист «Сообщения» с колонкой топика и автофильтром, «Список» ссылается на начало каждого топика
+XLSX_LAYOUTS = ("sheets", "table")
+
+COLUMNS = ("msg_id", "date", "topic_id", "topic", "sender_id", "author", "text", "media")
+
+
+def _hyperlink(path):
+    """Формула-ссылка на локальный файл вложения (путь относительно файла отчёта)."""
+    if not path:
+        return None
+    quoted = path.replace('"', '""')
+    return f'=HYPERLINK("{quoted}","{os.path.basename(quoted)}")'
+
+
+def _sheet_link(sheet, row):
+    """Формула-ссылка на строку row листа sheet той же книги."""
+    target = sheet.replace("'", "''").replace('"', '""')
+    label = f"{sheet}, строка {row}".replace('"', '""')
+    return f'=HYPERLINK("#\'{target}\'!A{row}","{label}")'
+
+
+def _topic_order(topics, counts):
+    """
+    Порядок топиков для листов: сначала известные (в порядке списка топиков),
+    затем встреченные в сообщениях, но отсутствующие в списке — по первому сообщению.
+    Пустые топики пропускаются.
+    """
+    order = [tid for tid in topics if tid in counts]
+    order += sorted((tid for tid in counts if tid not in topics), key=lambda tid: counts[tid][1])
+    return order
+
+
+def _topic_sheet_title(tname, tid, taken):
+    """
+    Название листа топика: имя топика, обрезанное до 31 символа. Если такое название уже занято
+    (taken — занятые названия в нижнем регистре: «Список», сводки, топик с тем же именем),
+    добавляется « #<id топика>» — иначе openpyxl сам переименует лист, и «Список» укажет на чужой.
+    """
+    title = tname[:31]
+    if title.lower() in taken:
+        suffix = f" #{tid}"
+        title = tname[:31 - len(suffix)] + suffix
+    return title
+
+
+# ----------------- SUMMARY -----------------
+class _DateCache:
+    """
+    Дата сообщения в часовом поясе отчёта: (строка DATE_FORMAT, ordinal дня, час).
+    Формат точен до минуты, поэтому подряд идущие сообщения одной минуты форматируются один раз.
+    """
+    __slots__ = ("tz", "minute", "value")
+
+    def __init__(self, tz):
+        self.tz = tz
+        self.minute = None
+        self.value = None
+
+    def get(self, ts):
+        minute = ts // 60
+        if minute != self.minute:
+            dt = datetime.datetime.fromtimestamp(ts, self.tz)
+            self.minute = minute
+            self.value = (dt.strftime(DATE_FORMAT), dt.toordinal(), dt.hour)
+        return self.value
+
+    def format(self, ts):
+        return datetime.datetime.fromtimestamp(ts, self.tz).strftime(DATE_FORMAT)
+
+
+class _Summary:
+    """
+    Сводка, собираемая за тот же проход, которым пишутся листы сообщений:
+    по каждому автору и топику — [число сообщений, первое, последнее (unix), суммарная длина текста],
+    число сообщений по дням (ordinal даты) и по часам суток в часовом поясе отчёта.
+    Листы создаются сразу (чтобы стоять перед листами топиков), а заполняются в write().
+    """
+    __slots__ = ("authors", "topics", "days", "hours", "sheets")
+
+    def __init__(self, wb, max_rows):
+        self.authors = {}
+        self.topics = {}
+        self.days = Counter()
+        self.hours = [0] * 24
+        self.sheets = (
+            _SplitSheet(wb, "Авторы", [["Автор", "Сообщений", "Первое", "Последнее", "Средняя длина"]], max_rows),
+            _SplitSheet(wb, "По дням", [["Дата", "Сообщений"]], max_rows),
+            _SplitSheet(wb, "По часам", [["Час", "Сообщений"]], max_rows),
+        )
+
+    @staticmethod
+    def _add(table, key, ts, size):
+        acc = table.get(key)
+        if acc is None:
+            table[key] = [1, ts, ts, size]
+        else:
+            acc[0] += 1
+            if ts < acc[1]:
+                acc[1] = ts
+            if ts > acc[2]:
+                acc[2] = ts
+            acc[3] += size
+
+    def add(self, tid, author, ts, day, hour, size):
+        self._add(self.authors, author, ts, size)
+        self._add(self.topics, tid, ts, size)
+        self.days[day] += 1
+        self.hours[hour] += 1
+
+    def write(self, dates):
+        """Заполняет листы «Авторы», «По дням» и «По часам»; dates — _DateCache отчёта."""
+        ws_authors, ws_days, ws_hours = self.sheets
+        for author, (count, first, last, size) in sorted(self.authors.items(), key=lambda kv: (-kv[1][0], kv[0])):
+            ws_authors.append((author, count, dates.format(first), dates.format(last), round(size / count, 1)))
+
+        if self.days:
+            # дни без сообщений тоже выводятся — так по листу сразу строится график
+            for day in range(min(self.days), max(self.days) + 1):
+                ws_days.append((datetime.date.fromordinal(day).isoformat(), self.days.get(day, 0)))
+
+        for hour, count in enumerate(self.hours):
+            ws_hours.append((f"{hour:02d}:00", count))
+
+
+# ----------------- XLSX -----------------
+class _SplitSheet:
+    """
+    Лист write-only книги: после max_rows строк продолжается на новом листе с той же шапкой,
+    вставленном сразу за предыдущей частью. С autofilter на каждой части закрепляется шапка
+    и ставится автофильтр по всем её строкам (диапазон известен только после записи — см. finish).
+    """
+    __slots__ = ("wb", "title", "header", "max_rows", "autofilter", "part", "ws", "rows")
+
+    def __init__(self, wb, title, header, max_rows, autofilter=False):
+        self.wb = wb
+        self.title = title
+        self.header = header
+        self.max_rows = max(max_rows, len(header) + 1)
+        self.autofilter = autofilter
+        self.part = 0
+        self.ws = None
+        self._next_sheet()
+
+    def _next_sheet(self):
+        self.finish()
+        self.part += 1
+        title = self.title
+        if self.part > 1:
+            suffix = f" ({self.part})"
+            title = title[:31 - len(suffix)] + suffix
+        # листы топиков могли появиться после этого листа — продолжение ставим рядом с ним
+        index = None if self.ws is None else self.wb.index(self.ws) + 1
+        self.ws = self.wb.create_sheet(title=title, index=index)
+        if self.autofilter:
+            self.ws.freeze_panes = f"A{len(self.header) + 1}"
+        for row in self.header:
+            self.ws.append(row)
+        self.rows = len(self.header)
+
+    def append(self, row):
+        if self.rows >= self.max_rows:
+            self._next_sheet()
+        self.ws.append(row)
+        self.rows += 1
+
+    def anchor(self):
+        """(название листа, номер строки), куда ляжет следующая строка."""
+        if self.rows >= self.max_rows:
+            self._next_sheet()
+        return self.ws.title, self.rows + 1
+
+    def finish(self):
+        """Ставит автофильтр на текущую часть; вызывается после последней строки."""
+        if self.autofilter and self.ws is not None:
+            from openpyxl.utils import get_column_letter
+            self.ws.auto_filter.ref = f"A{len(self.header)}:{get_column_letter(len(self.header[-1]))}{self.rows}"
+
+
+def write_workbook(filename, store, chat_id, start_date, end_date, topics, tz=None, topic_ids=None,
+                   max_rows=XLSX_MAX_ROWS, layout="sheets"):
+    """
+    Записывает xlsx из MessageStore в режиме write-only: строки читаются из SQLite
+    потоково и сразу уходят в XML листа, так что память не растёт с числом сообщений.
+    layout="sheets": листы «Все сообщения», «Список» (с первым/последним сообщением и средней длиной
+    по топикам), сводки «Авторы», «По дням», «По часам» и по одному листу на каждый непустой топик;
+    каждое сообщение читается и форматируется один раз и сразу пишется и в «Все сообщения»,
+    и в лист своего топика, и в сводку (_Summary).
+    layout="table": вместо них один лист «Сообщения» с колонкой «Топик», закреплённой шапкой
+    и автофильтром — каждый текст хранится в файле один раз. Сообщения идут блоками по топикам,
+    и в «Списке» вместо названия листа — ссылка на первую строку блока.
+    Лист длиннее max_rows строк продолжается на следующем. Если есть скачанные вложения,
+    добавляется колонка «Вложение» со ссылкой на файл (формула HYPERLINK: write-only лист
+    не поддерживает гиперссылки ячеек).
+    tz — часовой пояс дат (None — локальный); topic_ids — только эти топики.
+    Возвращает время фаз: {"write_rows": ..., "save": ...}.
+    """
+    if layout not in XLSX_LAYOUTS:
+        raise ValueError(f"Неизвестная раскладка xlsx: {layout} (доступны: {', '.join(XLSX_LAYOUTS)})")
+    table = layout == "table"
+    # openpyxl импортируется при первой записи книги, а не при запуске программы
+    from openpyxl import Workbook
+
+    t0 = time.perf_counter()
+    start_ts, end_ts = int(start_date.timestamp()), int(end_date.timestamp())
+    counts = store.topic_counts(chat_id, start_ts, end_ts, topic_ids)
+    order = _topic_order(topics, counts)
+    media = store.has_media(chat_id, start_ts, end_ts, topic_ids)
+    extra = ["Вложение"] if media else []
+    dates = _DateCache(tz)
+
+    wb = Workbook(write_only=True)
+    ws_all = _SplitSheet(wb, "Сообщения" if table else "Все сообщения",
+                         [["Топик", "Автор", "Дата", "Сообщение"] + extra], max_rows, autofilter=table)
+    ws_list = _SplitSheet(wb, "Список", [["ID", "Топик", "Начало" if table else "Название листа",
+                                          "Кол-во сообщений", "Первое", "Последнее", "Средняя длина"]], max_rows)
+    summary = _Summary(wb, max_rows)
+
+    ws_topic = None
+    for tid in order:
+        tname = topics.get(tid, f"Topic {tid}")
+        if table:
+            place = _sheet_link(*ws_all.anchor())
+        else:
+            title = _topic_sheet_title(tname, tid, {name.lower() for name in wb.sheetnames})
+            ws_topic = _SplitSheet(wb, title, [[tname], ["Автор", "Дата", "Сообщение"] + extra], max_rows)
+            place = ws_topic.ws.title
+        for author, date, text, path in store.iter_topic(chat_id, tid, start_ts, end_ts):
+            formatted, day, hour = dates.get(date)
+            summary.add(tid, author, date, day, hour, len(text))
+            if media:
+                link = _hyperlink(path)
+                ws_all.append((tname, author, formatted, text, link))
+                if ws_topic is not None:
+                    ws_topic.append((author, formatted, text, link))
+            else:
+                ws_all.append((tname, author, formatted, text))
+                if ws_topic is not None:
+                    ws_topic.append((author, formatted, text))
+        count, first, last, size = summary.topics[tid]
+        ws_list.append((tid, tname, place, count, dates.format(first), dates.format(last),
+                        round(size / count, 1)))
+    ws_all.finish()
+    summary.write(dates)
+
+    t1 = time.perf_counter()
+    wb.save(filename)
+    wb.close()
+    return {"write_rows": t1 - t0, "save": time.perf_counter() - t1}
+
+
+# ----------------- CSV / PARQUET -----------------
+def _message_rows(store, chat_id, start_date, end_date, topics, topic_ids):
+    """Строки (msg_id, date, topic_id, topic, sender_id, author, text, media) по возрастанию msg_id; date — unix-время."""
+    start_ts, end_ts = int(start_date.timestamp()), int(end_date.timestamp())
+    for msg_id, date, tid, sender_id, author, text, media in store.iter_messages(chat_id, start_ts, end_ts,
+                                                                                 topic_ids):
+        yield msg_id, date, tid, topics.get(tid, f"Topic {tid}"), sender_id, author, text, media
+
+
+def write_csv(filename, store, chat_id, start_date, end_date, topics, tz=None, topic_ids=None):
+    """
+    Одна таблица всех сообщений по возрастанию msg_id с колонками COLUMNS; строки пишутся потоково.
+    Дата — ISO 8601 со смещением часового пояса tz (None — локальный).
+    UTF-8 с BOM, чтобы Excel открывал кириллицу без импорта.
+    """
+    t0 = time.perf_counter()
+    tmp = filename + ".tmp"
+    with open(tmp, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for msg_id, date, tid, tname, sender_id, author, text, media in _message_rows(
+                store, chat_id, start_date, end_date, topics, topic_ids):
+            date = datetime.datetime.fromtimestamp(date, datetime.timezone.utc).astimezone(tz).isoformat()
+            writer.writerow((msg_id, date, tid, tname, sender_id, author, text, media))
+    os.replace(tmp, filename)
+    return {"write_csv": time.perf_counter() - t0}
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError("Для формата parquet нужен пакет pyarrow: pip install pyarrow")
+    return pyarrow
+
+
+def write_parquet(filename, store, chat_id, start_date, end_date, topics, tz=None, topic_ids=None,
+                  row_group=PARQUET_ROW_GROUP):
+    """
+    Parquet с колонками COLUMNS: строки копятся пачками по row_group и пишутся
+    отдельными группами строк, так что в памяти держится только одна пачка.
+    date — timestamp UTC (tz не нужен: часовой пояс применяет читающая программа).
+    """
+    pa = _import_pyarrow()
+    t0 = time.perf_counter()
+    schema = pa.schema([
+        ("msg_id", pa.int64()),
+        ("date", pa.timestamp("s", tz="UTC")),
+        ("topic_id", pa.int64()),
+        ("topic", pa.string()),
+        ("sender_id", pa.int64()),
+        ("author", pa.string()),
+        ("text", pa.string()),
+        ("media", pa.string()),
+    ])
+
+    def flush(writer, batch):
+        columns = list(zip(*batch))
+        writer.write_batch(pa.record_batch([pa.array(col, type=field.type) for col, field in zip(columns, schema)],
+                                           schema=schema))
+
+    tmp = filename + ".tmp"
+    with pa.parquet.ParquetWriter(tmp, schema) as writer:
+        batch = []
+        for row in _message_rows(store, chat_id, start_date, end_date, topics, topic_ids):
+            batch.append(row)
+            if len(batch) >= row_group:
+                flush(writer, batch)
+                batch = []
+        if batch:
+            flush(writer, batch)
+    os.replace(tmp, filename)
+    return {"write_parquet": time.perf_counter() - t0}
+
+
+WRITERS = {
+    "xlsx": write_workbook,
+    "csv": write_csv,
+    "parquet": write_parquet,
+}
+
+
+def write_file(fmt, filename, store, chat_id, start_date, end_date, topics, tz=None, topic_ids=None, layout=None):
+    """Пишет файл формата fmt; layout — раскладка xlsx (XLSX_LAYOUTS, None — "sheets"), у прочих форматов её нет."""
+    if fmt == "xlsx" and layout:
+        return write_workbook(filename, store, chat_id, start_date, end_date, topics, tz, topic_ids, layout=layout)
+    return WRITERS[fmt](filename, store, chat_id, start_date, end_date, topics, tz, topic_ids)
+
+
+def check_formats(formats, layout=None):
+    """
+    Проверяет список форматов и раскладку xlsx до загрузки сообщений;
+    ValueError — неизвестный формат, раскладка или нет зависимости.
+    """
+    if layout and layout not in XLSX_LAYOUTS:
+        raise ValueError(f"Неизвестная раскладка xlsx: {layout} (доступны: {', '.join(XLSX_LAYOUTS)})")
+    if not formats:
+        raise ValueError("Не указан ни один формат файла.")
+    for fmt in formats:
+        if fmt not in WRITERS:
+            raise ValueError(f"Неизвестный формат: {fmt} (доступны: {', '.join(WRITERS)})")
+        if fmt == "parquet":
+            _import_pyarrow()
+
+
+def write_job(fmt, filename, store_path, chat_id, start_date, end_date, topics, tz=None, topic_ids=None,
+              layout=None):
+    """Точка входа для пула процессов: открывает хранилище по пути и пишет файл формата fmt (write_file)."""
+    store = MessageStore(store_path, readonly=True)
+    try:
+        return write_file(fmt, filename, store, chat_id, start_date, end_date, topics, tz, topic_ids, layout)
+    finally:
+        store.close()